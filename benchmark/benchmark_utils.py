@@ -0,0 +1,19 @@
+# Helpers shared by the benchmark scripts: the timestamped print of p4-gource, and the loading of p4-gource.py
+# as a module, which its dashed filename prevents from being imported.
+
+import builtins
+import datetime
+import importlib.util
+import os
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+
+def print(*args, **kwargs):
+	timestamp = datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
+	builtins.print(f"{timestamp} {' '.join(map(str, args))}", **kwargs)
+
+def load_p4_gource():
+	spec = importlib.util.spec_from_file_location("p4_gource", os.path.join(benchmark_dir, os.pardir, "p4-gource.py"))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
@@ -0,0 +1,166 @@
+#!  /usr/bin/python
+
+# Stand-in for the p4 command line client, serving a synthetic depot generated on the fly, so that p4-gource can be run and measured offline.
+# The depot is described by a JSON configuration in the FAKE_P4_DEPOT environment variable, see default_depot for the available settings.
+# Only the commands used by p4-gource are supported, with -G output: describe -s, changes and files.
+
+import json
+import marshal
+import os
+import random
+import sys
+import time
+
+default_depot = {
+	"changelists": 10000,		# Highest changelist number
+	"files_per_change": 5,		# Maximum number of files per changelist, the actual number is random
+	"path_depth": 4,			# Number of directories between //depot and the files
+	"directories": 8,			# Number of directory names per level
+	"files_per_directory": 50,	# Number of file names per directory
+	"empty_ratio": 0.5,			# Ratio of changelist numbers not taken by a submitted changelist
+	"non_utf8_ratio": 0.05,		# Ratio of changelists with a cp1252 description, as sent by a non unicode server
+	"users": 20,
+	"seed": 1,
+	"start_time": 1262304000,	# Submit time of changelist 1
+	"interval": 600,			# Seconds between two changelist numbers
+	"latency": 0.0,				# Seconds spent by each p4 process before answering, to simulate the server round trip
+	"growth": 0.0,				# New changelists submitted per second since growth_start, to simulate a live server
+	"growth_start": 0,
+}
+
+actions = ["add", "edit", "edit", "edit", "integrate", "branch", "delete", "move/add", "move/delete"]
+
+def load_depot():
+	depot = dict(default_depot)
+	depot.update(json.loads(os.environ.get("FAKE_P4_DEPOT", "{}")))
+	if depot["growth"]:
+		depot["changelists"] += int((time.time() - depot["growth_start"]) * depot["growth"])
+	return depot
+
+def changelist_random(depot, change):
+	return random.Random(depot["seed"] * 1000003 + change)
+
+def changelist_exists(depot, change):
+	return 1 <= change <= depot["changelists"] and changelist_random(depot, change).random() >= depot["empty_ratio"]
+
+def generate_changelist(depot, change):
+	rand = changelist_random(depot, change)
+	rand.random()  # Consumed by changelist_exists
+	files = {}
+	for _ in range(rand.randint(1, depot["files_per_change"])):
+		top = rand.randrange(depot["directories"])
+		path = "//depot/" + "/".join(f"dir{top}_{level}_{rand.randrange(depot['directories'])}" for level in range(depot["path_depth"]))
+		path += f"/file{rand.randrange(depot['files_per_directory'])}.cpp"
+		files[path] = rand.choice(actions)
+	description = f"Synthetic change {change}"
+	if rand.random() < depot["non_utf8_ratio"]:
+		description = (description + " café – résumé").encode("cp1252")
+	return {
+		"change": change,
+		"user": f"user{rand.randrange(depot['users'])}",
+		"client": "bench_ws",
+		"time": depot["start_time"] + change * depot["interval"],
+		"desc": description,
+		"files": sorted(files.items()),
+	}
+
+def emit(record):
+	def encode(value):
+		return value if isinstance(value, bytes) else str(value).encode("utf-8")
+	marshal.dump({encode(key): encode(value) for key, value in record.items()}, sys.stdout.buffer, 0)
+
+def parse_path_range(depot, spec):
+	""" Split a path@start,@end specification into the path prefix and the changelist range. """
+	path, _, revisions = spec.partition("@")
+	prefix = path[:-3] if path.endswith("...") else path
+	start, end = 1, depot["changelists"]
+	if revisions:
+		first, _, last = revisions.partition(",")
+		start = int(first.lstrip("@"))
+		end = start if not last else (depot["changelists"] if last == "#head" else int(last.lstrip("@")))
+		if not last:
+			start = 1
+	return prefix, start, end
+
+def describe(depot, args):
+	for change in (int(arg) for arg in args if not arg.startswith("-")):
+		if not changelist_exists(depot, change):
+			emit({"code": "error", "data": f"Change {change} unknown.\n", "severity": 3, "generic": 17})
+			continue
+		changelist = generate_changelist(depot, change)
+		record = {"code": "stat", "change": change, "user": changelist["user"], "client": changelist["client"],
+			"time": changelist["time"], "desc": changelist["desc"], "status": "submitted"}
+		for index, (path, action) in enumerate(changelist["files"]):
+			record.update({f"depotFile{index}": path, f"action{index}": action, f"rev{index}": 1, f"type{index}": "text"})
+		emit(record)
+
+def changes(depot, args):
+	max_count = None
+	specs = []
+	arguments = iter(args)
+	for arg in arguments:
+		if arg == "-m":
+			max_count = int(next(arguments))
+		elif arg == "-s":
+			next(arguments)
+		else:
+			specs.append(arg)
+	specs = specs or ["//..."]
+	ranges = [parse_path_range(depot, spec) for spec in specs]
+	start = min(start for prefix, start, end in ranges)
+	end = max(end for prefix, start, end in ranges)
+	prefixes = [prefix.replace("//...", "//") for prefix, first, last in ranges]
+
+	count = 0
+	for change in range(end, start - 1, -1):
+		if not changelist_exists(depot, change):
+			continue
+		changelist = generate_changelist(depot, change)
+		if not any(path.startswith(prefix) for path, action in changelist["files"] for prefix in prefixes):
+			continue
+		emit({"code": "stat", "change": change, "user": changelist["user"], "client": changelist["client"],
+			"time": changelist["time"], "desc": changelist["desc"], "status": "submitted"})
+		count += 1
+		if max_count and count >= max_count:
+			break
+
+def files(depot, args):
+	for spec in (arg for arg in args if not arg.startswith("-")):
+		prefix, start, end = parse_path_range(depot, spec)
+		heads = {}
+		for change in range(1, end + 1):
+			if changelist_exists(depot, change):
+				for path, action in generate_changelist(depot, change)["files"]:
+					if path.startswith(prefix):
+						revision = heads.get(path, (0, None, None))[0] + 1
+						heads[path] = (revision, action, change)
+		found = False
+		for path in sorted(heads):
+			revision, action, change = heads[path]
+			if action in ("delete", "move/delete"):
+				continue
+			found = True
+			emit({"code": "stat", "depotFile": path, "rev": revision, "change": change, "action": action, "type": "text", "time": 0})
+		if not found:
+			emit({"code": "error", "data": f"{spec} - no such file(s).\n", "severity": 2, "generic": 17})
+
+def main(argv):
+	# Global options, only -G output is supported
+	while argv and argv[0].startswith("-"):
+		argv = argv[2:] if argv[0] in ("-p", "-u", "-c", "-P") else argv[1:]
+	if not argv:
+		sys.stderr.write("Missing command\n")
+		return 1
+
+	depot = load_depot()
+	time.sleep(depot["latency"])
+	command, args = argv[0], argv[1:]
+	commands = {"describe": describe, "changes": changes, "files": files}
+	if command not in commands:
+		sys.stderr.write(f"Unsupported command: {command}\n")
+		return 1
+	commands[command](depot, args)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,117 @@
+#!  /usr/bin/python
+
+# Benchmark of the merge of many Gource shards into the final log: synthetic shards of consecutive changelist ranges,
+# some of them overlapping the previous one, are merged and the result is checked to be sorted, to have lost the events
+# of the overlaps only once, and to have kept the events repeated at the same second by consecutive changelists.
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmark_utils import load_p4_gource, print
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Time the merge of many Gource shards, some of them overlapping, and check its output.")
+	parser.add_argument("--shards", type=int, default=120, help="Number of shards besides the init file")
+	parser.add_argument("--shard-size", type=int, default=1000, help="Changelists per shard")
+	parser.add_argument("--events-per-change", type=int, default=10, help="Events per changelist")
+	parser.add_argument("--overlap-every", type=int, default=10, help="Every this many shards, a shard also covers the second half of the previous one")
+	parser.add_argument("--init-size", type=int, default=50000, help="Files of the init file")
+	parser.add_argument("--keep", action='store_true', help="Keep the working directory with the generated files")
+	parser.add_argument("-v", "--verbose", action='store_true', help="Show the output of p4-gource")
+	return parser.parse_args()
+
+def changelist_timestamp(change):
+	# Every 50th changelist is submitted after the next one, the merge must reorder them
+	return 1262304000 + 60 * change + (90 if change % 50 == 0 else 0)
+
+def changelist_events(change, shard_size, events_per_change):
+	""" Events of a changelist, the same whichever shard it is written to. The first changelist of each shard repeats
+	the events of the last one of the previous shard at the same second, these are real events and must be kept. """
+	if change % shard_size == 1 and change > 1:
+		return changelist_events(change - 1, shard_size, events_per_change)
+	rng = random.Random(change)
+	timestamp = changelist_timestamp(change)
+	user = f"user{rng.randrange(50)}"
+	return [f"{timestamp}|{user}|{rng.choice('AMD')}|/dir{rng.randrange(100)}/file{rng.randrange(1000)}.c\n" for _ in range(events_per_change)]
+
+def write_shards(args):
+	""" Write the init file and the shards, returning their filenames, their changelist ranges and the number of distinct events. """
+	with open("merge_init.gource", 'w') as init_file:
+		for i in range(args.init_size):
+			init_file.write(f"0|init|A|/dir{i % 100}/init{i}.c\n")
+	gource_files, shard_ranges = ["merge_init.gource"], [None]
+	for shard in range(args.shards):
+		start, end = shard * args.shard_size + 1, (shard + 1) * args.shard_size
+		if shard and shard % args.overlap_every == 0:
+			start -= args.shard_size // 2
+		filename = f"merge_{start}-{end}.gource"
+		with open(filename, 'w') as shard_file:
+			for change in range(start, end + 1):
+				shard_file.writelines(changelist_events(change, args.shard_size, args.events_per_change))
+		gource_files.append(filename)
+		shard_ranges.append((start, end))
+	expected_events = args.init_size + args.shards * args.shard_size * args.events_per_change
+	return gource_files, shard_ranges, expected_events
+
+def max_rss_mb():
+	try:
+		import resource
+	except ImportError:
+		return None
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Bytes on macOS, kilobytes elsewhere
+	return rss / (1 << 20) if sys.platform == 'darwin' else rss / 1024
+
+def main(args):
+	p4_gource = load_p4_gource()
+	work_dir = tempfile.mkdtemp(prefix="p4-gource-merge-benchmark_")
+	previous_dir = os.getcwd()
+	os.chdir(work_dir)
+	output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+	try:
+		gource_files, shard_ranges, expected_events = write_shards(args)
+		total_lines = 0
+		for filename in gource_files:
+			with open(filename, 'rb') as f:
+				total_lines += sum(1 for _ in f)
+		print(f"Merging {len(gource_files)} shards, {total_lines} lines, in {work_dir}")
+
+		start_time = time.perf_counter()
+		with output:
+			p4_gource.concatenate_gource_logs(gource_files, "merged.gource", False)
+		concatenate_seconds = time.perf_counter() - start_time
+		print(f"concatenate {concatenate_seconds:8.2f}s {total_lines / max(concatenate_seconds, 1e-6):12.0f} lines/s")
+
+		start_time = time.perf_counter()
+		with output:
+			p4_gource.concatenate_gource_logs(gource_files, "merged_sorted.gource", True, shard_ranges=shard_ranges)
+		merge_seconds = time.perf_counter() - start_time
+		rss = max_rss_mb()
+		print(f"merge       {merge_seconds:8.2f}s {total_lines / max(merge_seconds, 1e-6):12.0f} lines/s" + (f", {rss:.0f} MB max RSS" if rss else ""))
+
+		events, previous_timestamp, unsorted = 0, 0, 0
+		with open("merged_sorted.gource", 'rb') as merged:
+			for line in merged:
+				timestamp = int(line.split(b'|', 1)[0])
+				unsorted += timestamp < previous_timestamp
+				previous_timestamp = timestamp
+				events += 1
+	finally:
+		os.chdir(previous_dir)
+		if args.keep:
+			print(f"Generated files kept in {work_dir}")
+		else:
+			shutil.rmtree(work_dir, ignore_errors=True)
+
+	print(f"Merged {events} events, expected {expected_events}, {unsorted} out of order")
+	return 0 if events == expected_events and not unsorted else 1
+
+if __name__ == "__main__":
+	sys.exit(main(parse_args()))
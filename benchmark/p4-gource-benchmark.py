@@ -0,0 +1,183 @@
+#!  /usr/bin/python
+
+# Offline benchmark of p4-gource: a synthetic depot is served by fake-p4.py in place of the p4 client,
+# and the main stages are timed end to end on it. The timings can be saved as a baseline and later runs
+# compared against it, failing when a stage got slower than the tolerance allows.
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import datetime
+
+from benchmark_utils import benchmark_dir, load_p4_gource, print
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Time the p4-gource stages on a synthetic depot served by a stand-in p4 executable.")
+	parser.add_argument("-c", "--changelists", type=int, default=20000, help="Highest changelist number of the synthetic depot")
+	parser.add_argument("-f", "--files-per-change", type=int, default=5, help="Maximum number of files per changelist")
+	parser.add_argument("-d", "--path-depth", type=int, default=4, help="Number of directories between //depot and the files")
+	parser.add_argument("--empty-ratio", type=float, default=0.5, help="Ratio of changelist numbers not taken by a submitted changelist")
+	parser.add_argument("--non-utf8-ratio", type=float, default=0.05, help="Ratio of changelists with a non UTF-8 description")
+	parser.add_argument("--latency", type=float, default=0.0, help="Seconds spent by each fake p4 process, to simulate the server round trip")
+	parser.add_argument("--seed", type=int, default=1, help="Seed of the synthetic depot")
+	parser.add_argument("-b", "--batch-size", type=int, default=5000, help="Batch size of the fetch")
+	parser.add_argument("-j", "--jobs", type=int, default=4, help="Concurrent p4 processes of the fetch")
+	parser.add_argument("--convert-jobs", type=int, default=1, help="Worker processes of the conversion in generate_gource")
+	parser.add_argument("--describe-size", type=int, default=50, help="Changelists per p4 describe process")
+	parser.add_argument("--baseline", help="Results file of an earlier run to compare with, the benchmark fails when a stage is slower than allowed")
+	parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown of each stage relative to the baseline (0.25 for 25%%)")
+	parser.add_argument("--save", help="Write the results of this run to this file, to use as a baseline")
+	parser.add_argument("--keep", action='store_true', help="Keep the working directory with the generated files")
+	parser.add_argument("-v", "--verbose", action='store_true', help="Show the output of p4-gource")
+	return parser.parse_args()
+
+def install_fake_p4(work_dir, depot):
+	""" Put a p4 executable running fake-p4.py first in the PATH, serving the depot. """
+	bin_dir = os.path.join(work_dir, "bin")
+	os.makedirs(bin_dir)
+	fake_p4 = os.path.join(benchmark_dir, "fake-p4.py")
+	if os.name == 'nt':
+		with open(os.path.join(bin_dir, "p4.bat"), 'w') as script:
+			script.write(f'@"{sys.executable}" "{fake_p4}" %*\n')
+	else:
+		script_path = os.path.join(bin_dir, "p4")
+		with open(script_path, 'w') as script:
+			script.write(f'#!/bin/sh\nexec "{sys.executable}" "{fake_p4}" "$@"\n')
+		os.chmod(script_path, 0o755)
+	os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+	os.environ["FAKE_P4_DEPOT"] = json.dumps(depot)
+
+def count_lines(filenames):
+	count = 0
+	for filename in filenames:
+		with open(filename, 'rb') as f:
+			count += sum(1 for _ in f)
+	return count
+
+class Benchmark:
+	""" Time the stages and keep, for each of them, the seconds and the number of items processed. """
+
+	def __init__(self, verbose):
+		self.verbose = verbose
+		self.results = {}
+
+	def output(self):
+		return contextlib.nullcontext() if self.verbose else contextlib.redirect_stdout(io.StringIO())
+
+	def run(self, name, unit, function):
+		""" Run the function, which returns the number of items it processed. """
+		start_time = time.perf_counter()
+		with self.output():
+			items = function()
+		seconds = time.perf_counter() - start_time
+		self.results[name] = {"seconds": round(seconds, 3), "items": items, "unit": unit, "items_per_second": round(items / max(seconds, 1e-6), 1)}
+		print(f"{name:<22} {seconds:8.2f}s {items:10d} {unit:<12} {items / max(seconds, 1e-6):12.1f} {unit}/s")
+
+def compare(results, baseline, tolerance):
+	""" Return the stages slower than the baseline by more than the tolerance. """
+	regressions = []
+	for name, result in results.items():
+		reference = baseline["stages"].get(name)
+		if reference is None:
+			continue
+		# Compare throughputs, so that baselines taken on a different depot size remain meaningful
+		if result["items_per_second"] < reference["items_per_second"] / (1 + tolerance):
+			regressions.append((name, reference["items_per_second"], result["items_per_second"]))
+	return regressions
+
+def main(args):
+	depot = {
+		"changelists": args.changelists,
+		"files_per_change": args.files_per_change,
+		"path_depth": args.path_depth,
+		"empty_ratio": args.empty_ratio,
+		"non_utf8_ratio": args.non_utf8_ratio,
+		"latency": args.latency,
+		"seed": args.seed,
+	}
+	work_dir = tempfile.mkdtemp(prefix="p4-gource-benchmark_")
+	install_fake_p4(work_dir, depot)
+	p4_gource = load_p4_gource()
+	previous_dir = os.getcwd()
+	os.chdir(work_dir)
+	print(f"Benchmarking on {args.changelists} changelists in {work_dir}")
+
+	include_paths = ["//depot/..."]
+	exclude_paths = ["//depot/dir0_..."]
+	regex_match = [r"^//depot/(dir\d+)_\d+_"]
+	regex_replace = [r"\1/"]
+	out_base = "bench"
+	benchmark = Benchmark(args.verbose)
+	try:
+		ranges = p4_gource.calculate_ranges(1, args.changelists, args.batch_size, out_base)
+		p4_logs = []
+		def fetch():
+			p4_logs.extend(p4_gource.fetch_p4_log(ranges, out_base, include_paths, exclude_paths, args.jobs, args.describe_size))
+			return args.changelists
+		benchmark.run("fetch_p4_log", "changelists", fetch)
+
+		gource_logs = [p4_log[:-len(".p4.log")] + ".gource" for p4_log in p4_logs]
+		def convert():
+			for p4_log, gource_log in zip(p4_logs, gource_logs):
+				p4_gource.p4_to_gource(p4_log, gource_log, include_paths, exclude_paths, regex_match, regex_replace)
+			return count_lines(gource_logs)
+		benchmark.run("p4_to_gource", "events", convert)
+
+		# From the server first, on an output without any log to derive it from, then derived from an earlier snapshot
+		init_revision = args.changelists // 2
+		def init_server():
+			return count_lines([p4_gource.fetch_p4_init(init_revision, "server", include_paths, exclude_paths, regex_match, regex_replace)])
+		benchmark.run("fetch_p4_init", "files", init_server)
+		with benchmark.output():
+			p4_gource.fetch_p4_init(1, out_base, include_paths, exclude_paths, regex_match, regex_replace)
+		def init_derived():
+			return count_lines([p4_gource.fetch_p4_init(init_revision, out_base, include_paths, exclude_paths, regex_match, regex_replace)])
+		benchmark.run("fetch_p4_init_derived", "files", init_derived)
+
+		# Conversion, init and merge of the whole range, from the P4 logs
+		for filename in gource_logs + glob.glob(f"{out_base}_init_*.gource"):
+			os.remove(filename)
+		def generate():
+			return count_lines([p4_gource.generate_gource(1, args.changelists, out_base, include_paths, exclude_paths, False, regex_match, regex_replace, args.convert_jobs)])
+		benchmark.run("generate_gource", "events", generate)
+
+		gource_files = [f"{out_base}_init_{ranges[0][0]}.gource"] + gource_logs
+		for merge in (False, True):
+			target = f"concatenated_{merge}.gource"
+			def concatenate():
+				p4_gource.concatenate_gource_logs(gource_files, target, merge)
+				return count_lines([target])
+			benchmark.run("merge" if merge else "concatenate", "events", concatenate)
+	finally:
+		os.chdir(previous_dir)
+		if args.keep:
+			print(f"Generated files kept in {work_dir}")
+		else:
+			shutil.rmtree(work_dir, ignore_errors=True)
+
+	results = {"date": datetime.datetime.now().isoformat(timespec="seconds"), "depot": depot, "stages": benchmark.results}
+	if args.save:
+		with open(args.save, 'w', encoding='utf-8') as results_file:
+			json.dump(results, results_file, indent=1)
+		print(f"Results saved to {args.save}")
+
+	if args.baseline:
+		with open(args.baseline, 'r', encoding='utf-8') as baseline_file:
+			baseline = json.load(baseline_file)
+		regressions = compare(benchmark.results, baseline, args.tolerance)
+		for name, reference, current in regressions:
+			print(f"Regression in {name}: {current:.1f} items/s against {reference:.1f} items/s in the baseline")
+		if regressions:
+			return 1
+		print(f"No stage slower than the baseline by more than {args.tolerance:.0%}")
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(parse_args()))
@@ -0,0 +1,99 @@
+#!  /usr/bin/python
+
+# Micro-benchmark of the per-path cost of the include/exclude filters and of the path reductions of p4-gource,
+# against the implementations they replaced, which recompiled or rescanned every pattern for each path.
+# The results of both are checked to be identical.
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+from benchmark_utils import load_p4_gource, print
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Time the path filters and reductions per path, before and after they were compiled into matcher objects.")
+	parser.add_argument("-n", "--paths", type=int, default=200000, help="Number of file events")
+	parser.add_argument("--distinct-paths", type=int, default=20000, help="Number of distinct paths among the file events")
+	parser.add_argument("--includes", type=int, default=22, help="Number of include paths")
+	parser.add_argument("--excludes", type=int, default=18, help="Number of exclude paths")
+	parser.add_argument("--reductions", type=int, default=20, help="Number of regex match and replace rules")
+	parser.add_argument("--seed", type=int, default=1, help="Seed of the synthetic paths and rules")
+	return parser.parse_args()
+
+def legacy_filter_file(file, include_paths, exclude_paths, compile_path_patterns):
+	""" The filter as it was: the pattern lists compared on every call, then every regex tried. """
+	if not hasattr(legacy_filter_file, 'include_regexes') or legacy_filter_file.prev_include_paths != include_paths:
+		legacy_filter_file.include_regexes = compile_path_patterns(include_paths)
+		legacy_filter_file.prev_include_paths = include_paths
+	if not hasattr(legacy_filter_file, 'exclude_regexes') or legacy_filter_file.prev_exclude_paths != exclude_paths:
+		legacy_filter_file.exclude_regexes = compile_path_patterns(exclude_paths)
+		legacy_filter_file.prev_exclude_paths = exclude_paths
+
+	if legacy_filter_file.include_regexes:
+		if not any(regex.match(file) for regex in legacy_filter_file.include_regexes):
+			return False
+	if legacy_filter_file.exclude_regexes:
+		if any(regex.match(file) for regex in legacy_filter_file.exclude_regexes):
+			return False
+	return True
+
+def legacy_reduce_path(path, regex_matches, regex_replaces):
+	""" The reduction as it was: re.sub with the uncompiled rules on every call. """
+	reduced_path = path
+	for regex_match, regex_replace in zip(regex_matches, regex_replaces):
+		reduced_path = re.sub(regex_match, regex_replace, reduced_path)
+	return reduced_path
+
+def synthetic_config(args, rng):
+	""" Paths of a depot of projects and components, with include, exclude and reduce rules of the usual kinds. """
+	projects = max(args.includes, 30)
+	distinct_paths = []
+	for _ in range(args.distinct_paths):
+		project, component = rng.randrange(projects), rng.randrange(10)
+		directories = '/'.join(f"dir{rng.randrange(20)}" for _ in range(rng.randrange(1, 5)))
+		generated = "generated/" if rng.random() < 0.05 else ""
+		distinct_paths.append(f"//depot/proj{project}/comp{component}_{rng.choice(['core', 'ui', 'tools'])}/{generated}{directories}/file{rng.randrange(1000)}.{rng.choice(['c', 'h', 'py', 'txt'])}")
+	paths = [rng.choice(distinct_paths) for _ in range(args.paths)]
+
+	# Mostly plain prefixes, a few with a wildcard in the middle
+	include_paths = [f"//depot/proj{i}/..." for i in range(args.includes - 2)] + ["//depot/proj2.../tools...", "//depot/...dir7/..."][:args.includes]
+	exclude_paths = [f"//depot/proj{i}/comp{i % 10}_ui/..." for i in range(args.excludes - 1)] + ["//depot/.../generated/..."][:args.excludes]
+	regex_match = [rf"^//depot/proj{i}/comp(\d+)_\w+/" for i in range(args.reductions - 2)] + [r"/generated/", r"\.txt$"]
+	regex_replace = [rf"p{i}/c\1/" for i in range(args.reductions - 2)] + ["/", ".text"]
+	return paths, include_paths, exclude_paths, regex_match[:args.reductions], regex_replace[:args.reductions]
+
+def timed(function, paths):
+	start_time = time.perf_counter()
+	results = [function(path) for path in paths]
+	return results, (time.perf_counter() - start_time) / len(paths) * 1e6
+
+def main(args):
+	p4_gource = load_p4_gource()
+	rng = random.Random(args.seed)
+	paths, include_paths, exclude_paths, regex_match, regex_replace = synthetic_config(args, rng)
+	print(f"{len(paths)} paths ({args.distinct_paths} distinct), {len(include_paths)} include, {len(exclude_paths)} exclude and {len(regex_match)} reduce rules")
+
+	legacy_filtered, legacy_filter_us = timed(lambda path: legacy_filter_file(path, include_paths, exclude_paths, p4_gource.compile_path_patterns), paths)
+	file_filter = p4_gource.path_filter(include_paths, exclude_paths)
+	filtered, filter_us = timed(file_filter, paths)
+	print(f"filter_file   {legacy_filter_us:6.2f} us/path -> {filter_us:6.2f} us/path, {sum(filtered)} paths kept")
+
+	legacy_reduced, legacy_reduce_us = timed(lambda path: legacy_reduce_path(path, regex_match, regex_replace), paths)
+	# A reducer of its own, so that its memo starts empty
+	reducer = p4_gource.PathReducer(regex_match, regex_replace)
+	reduced_cold, reduce_cold_us = timed(reducer.reduce_uncached, paths)
+	reduced, reduce_us = timed(reducer, paths)
+	reduced_warm, reduce_warm_us = timed(reducer, paths)
+	print(f"reduce_path   {legacy_reduce_us:6.2f} us/path -> {reduce_cold_us:6.2f} us/path uncached, {reduce_us:6.2f} us/path memoized ({reduce_warm_us:.2f} once every path is)")
+
+	if filtered != legacy_filtered or reduced != legacy_reduced or reduced_cold != legacy_reduced or reduced_warm != legacy_reduced:
+		print("The results differ from the previous implementations")
+		return 1
+	print("Results identical to the previous implementations")
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(parse_args()))
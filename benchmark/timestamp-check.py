@@ -0,0 +1,92 @@
+#!  /usr/bin/python
+
+# Equivalence check of the cached P4 timestamp parsing of p4-gource with time.mktime(time.strptime(...)), the conversion it replaced,
+# over every hour of whole years, DST transitions included, in timezones with 1 hour, 30 minutes and no DST shifts.
+# The local timezone is switched with TZ, which needs time.tzset and so a Unix-like system.
+
+import argparse
+import os
+import sys
+import time
+import datetime
+
+from benchmark_utils import load_p4_gource, print
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Check that the cached P4 timestamp parsing of p4-gource matches time.mktime(time.strptime(...)) across DST transitions.")
+	parser.add_argument("--timezone", action="append", default=None,
+		help="Timezone to check (can specify multiple, default: America/New_York, Europe/Paris, Australia/Lord_Howe, Asia/Kolkata, America/Sao_Paulo and UTC)")
+	parser.add_argument("--year", type=int, action="append", default=None, help="Year to check every hour of (can specify multiple, default: 2007, 2019 and 2024)")
+	parser.add_argument("--server-timezone", action="store_true", default=False,
+		help="Also check --server-timezone with the local timezone set to UTC, outside of the hours repeated or skipped by DST, which mktime resolves its own way")
+	return parser.parse_args()
+
+# Minute and second offsets within each hour, on and around the quarter hour boundaries
+offsets = [(0, 0), (7, 30), (14, 59), (15, 0), (29, 59), (30, 0), (44, 1), (45, 0), (59, 59)]
+
+def timestamps(year):
+	hour = datetime.datetime(year, 1, 1)
+	while hour.year == year:
+		for minute, second in offsets:
+			yield hour.replace(minute=minute, second=second).strftime("%Y/%m/%d %H:%M:%S")
+		hour += datetime.timedelta(hours=1)
+
+def set_local_timezone(timezone):
+	os.environ["TZ"] = timezone
+	time.tzset()
+
+def is_ambiguous(timestamp, timezone):
+	""" Whether the local time is repeated or skipped by a DST change in the timezone. """
+	from zoneinfo import ZoneInfo
+	local = datetime.datetime.strptime(timestamp, "%Y/%m/%d %H:%M:%S")
+	earlier, later = local.replace(tzinfo=ZoneInfo(timezone), fold=0), local.replace(tzinfo=ZoneInfo(timezone), fold=1)
+	return earlier.utcoffset() != later.utcoffset()
+
+def check(p4_gource, timezone, years, server_timezone):
+	""" Compare the parsing of every timestamp with mktime in the timezone, returning the number checked and the mismatches. """
+	set_local_timezone(timezone)
+	all_timestamps = [timestamp for year in years for timestamp in timestamps(year)]
+
+	expected = [int(time.mktime(time.strptime(timestamp, "%Y/%m/%d %H:%M:%S"))) for timestamp in all_timestamps]
+
+	if server_timezone:
+		set_local_timezone("UTC")
+		p4_gource.server_timezone = timezone
+	else:
+		p4_gource.server_timezone = None
+	p4_gource.p4_slot_epoch.cache_clear()
+	actual = [p4_gource.parse_p4_timestamp(timestamp) for timestamp in all_timestamps]
+
+	mismatches = [(timestamp, e, a) for timestamp, e, a in zip(all_timestamps, expected, actual) if e != a]
+	if server_timezone:
+		mismatches = [mismatch for mismatch in mismatches if not is_ambiguous(mismatch[0], timezone)]
+	return len(all_timestamps), mismatches
+
+def main(args):
+	if not hasattr(time, "tzset"):
+		print("time.tzset is not available on this system, the local timezone cannot be switched")
+		return 1
+	p4_gource = load_p4_gource()
+	timezones = args.timezone or ["America/New_York", "Europe/Paris", "Australia/Lord_Howe", "Asia/Kolkata", "America/Sao_Paulo", "UTC"]
+	years = args.year or [2007, 2019, 2024]
+	previous_timezone = os.environ.get("TZ")
+	failed = False
+	try:
+		for server_timezone in ([False, True] if args.server_timezone else [False]):
+			for timezone in timezones:
+				count, mismatches = check(p4_gource, timezone, years, server_timezone)
+				mode = "server timezone" if server_timezone else "local timezone"
+				print(f"{timezone:<20} {mode:<15} {count} timestamps, {len(mismatches)} mismatches")
+				for timestamp, expected, actual in mismatches[:10]:
+					print(f"  {timestamp}: expected {expected}, got {actual}")
+				failed = failed or bool(mismatches)
+	finally:
+		if previous_timezone is None:
+			os.environ.pop("TZ", None)
+		else:
+			os.environ["TZ"] = previous_timezone
+		time.tzset()
+	return 1 if failed else 0
+
+if __name__ == "__main__":
+	sys.exit(main(parse_args()))
@@ -1,43 +1,69 @@
+import argparse
+import concurrent.futures
 import os
 
-def convert_file_to_utf8_with_underscore(file_path):
+def decode_line(line, fallback_encodings):
     """
-    Reads a binary file, attempts to decode it as UTF-8 replacing any undecodable bytes with '_',
-    and writes the output back to the same file in UTF-8 encoding.
+    Decodes a line as UTF-8, or with the first fallback encoding that can decode it,
+    or as UTF-8 replacing any undecodable bytes with '_'.
+    """
+    for encoding in ["utf-8"] + fallback_encodings:
+        try:
+            return line.decode(encoding)
+        except (UnicodeDecodeError, LookupError):
+            pass
+    return line.decode('utf-8', errors='replace').replace('\ufffd', '_')
+
+def convert_file_to_utf8_with_underscore(file_path, fallback_encodings=["cp1252"]):
+    """
+    Streams a binary file line by line, decoding each line as UTF-8 or with the fallback encodings,
+    and replaces the file with its UTF-8 version if any line was not UTF-8. Memory does not depend on the file size.
 
     Args:
     file_path (str): The path to the file to be converted.
+    fallback_encodings (list): The encodings tried on the lines which are not valid UTF-8.
     """
+    temp_path = file_path + ".utf8.temp"
     try:
-        # Read the file in binary mode
-        with open(file_path, 'rb') as file:
-            raw_data = file.read()
-        
-        # Decode the data, replace undecodable bytes with '_'
-        decoded_data = raw_data.decode('utf-8', errors='replace')
-        modified_data = decoded_data.replace('\ufffd', '_')
-        
-        # Write the modified data back to the file in UTF-8
-        with open(file_path, 'w', encoding='utf-8') as file:
-            file.write(modified_data)
-
-        print(f"Converted {file_path} successfully.")
-    
+        converted_lines = 0
+        with open(file_path, 'rb') as file, open(temp_path, 'wb') as temp_file:
+            for line in file:
+                try:
+                    line.decode('utf-8')
+                except UnicodeDecodeError:
+                    line = decode_line(line, fallback_encodings).encode('utf-8')
+                    converted_lines += 1
+                temp_file.write(line)
+
+        if converted_lines:
+            os.replace(temp_path, file_path)
+            print(f"Converted {file_path} successfully, {converted_lines} lines were not UTF-8.")
+        else:
+            os.remove(temp_path)
+            print(f"{file_path} is already UTF-8.")
+
     except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
         print(f"Failed to convert {file_path}: {e}")
 
-def convert_all_logs_to_utf8(directory):
+def convert_all_logs_to_utf8(directory, jobs=None, fallback_encodings=["cp1252"]):
     """
-    Converts all .log files in the specified directory to UTF-8 encoding.
+    Converts all .log files in the specified directory to UTF-8 encoding, in parallel processes.
 
     Args:
     directory (str): The directory to search for .log files and convert them.
+    jobs (int): The number of files converted in parallel, the number of CPUs by default.
+    fallback_encodings (list): The encodings tried on the lines which are not valid UTF-8.
     """
-    for filename in os.listdir(directory):
-        if filename.endswith(".log"):
-            file_path = os.path.join(directory, filename)
-            convert_file_to_utf8_with_underscore(file_path)
-
-# Example usage: convert all .log files in the current working directory
-current_directory = os.getcwd()
-convert_all_logs_to_utf8(current_directory)
\ No newline at end of file
+    file_paths = [os.path.join(directory, filename) for filename in sorted(os.listdir(directory)) if filename.endswith(".log")]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(convert_file_to_utf8_with_underscore, file_paths, [fallback_encodings] * len(file_paths)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert all the .log files of a directory to UTF-8.")
+    parser.add_argument("directory", nargs="?", default=os.getcwd(), help="Directory of the .log files (default: current working directory)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of files converted in parallel (default: number of CPUs)")
+    parser.add_argument("--fallback-encoding", action="append", default=None, help="Encoding tried on the lines which are not valid UTF-8 (can specify multiple, default: cp1252)")
+    args = parser.parse_args()
+    convert_all_logs_to_utf8(args.directory, args.jobs, args.fallback_encoding or ["cp1252"])
@@ -1,20 +1,40 @@
 #!  /usr/bin/python
 
-# TODO: improvement ideas, use -ztag output for the log fetching, and immediately discard based on include/exclude list, this will help make the resulting files a lot smaller
-# which also means we would probably generate the gource file directly instead of doing it in two steps, but it requires changing all the parsing and converting
-
 import argparse
+import array
+import bisect
+import cProfile
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import heapq
+import itertools
+import io
+import json
+import marshal
 import os
 import re
+import shutil
+import sqlite3
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import platform
+import random
 import datetime
 
 p4_server = None
 p4_user = None
 verbose = False
+server_timezone = None
+retry_delay = 1.0
+fallback_encodings = ["cp1252"]
+retry_max_delay = 60.0
+# (device, inode, modification time) and filenames of the last listing of the working directory
+directory_listing = None
 
 def print(*args, **kwargs):
 	timestamp = datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
@@ -30,6 +50,64 @@ def print(*args, **kwargs):
 	# Call the built-in print function with the prefixed message and other keyword arguments
 	builtins_print(prefixed_message, **kwargs)
 
+class RunMetrics:
+	""" Wall time and counters of each stage of the run, such as items processed, bytes read and written, subprocesses and retries.
+	Counters go to the innermost stage running on the main thread, including when they are counted from worker threads. """
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.stages = {}
+		self.current_stages = []
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		if name in self.current_stages:
+			# Already timed by the enclosing call
+			yield
+			return
+		self.current_stages.append(name)
+		start_time = time.time()
+		try:
+			yield
+		finally:
+			self.current_stages.pop()
+			self.add("seconds", time.time() - start_time, name)
+			self.add("runs", 1, name)
+
+	def add(self, counter, value=1, stage=None):
+		with self.lock:
+			if stage is None:
+				stage = self.current_stages[-1] if self.current_stages else "other"
+			counters = self.stages.setdefault(stage, {})
+			counters[counter] = counters.get(counter, 0) + value
+
+	def add_file_size(self, counter, filename):
+		if filename and os.path.exists(filename):
+			self.add(counter, os.path.getsize(filename))
+
+	def report(self):
+		""" Return the counters of each stage, with the throughput of every counter per second of the stage. """
+		stages = {}
+		for name, counters in self.stages.items():
+			stage = dict(counters)
+			seconds = counters.get("seconds", 0)
+			for counter, value in counters.items():
+				if seconds > 0 and counter not in ("seconds", "runs"):
+					stage[f"{counter}_per_second"] = round(value / seconds, 2)
+			stage["seconds"] = round(seconds, 3)
+			stages[name] = stage
+		return stages
+
+	def write(self, filename):
+		""" Print a summary and append the metrics of this run as a JSON line, to compare runs over time. """
+		stages = self.report()
+		for name, stage in stages.items():
+			print(f"Stage {name}: " + ", ".join(f"{counter} {value}" for counter, value in stage.items()))
+		with open(filename, 'a', encoding='utf-8') as metrics_file:
+			metrics_file.write(json.dumps({"date": datetime.datetime.now().isoformat(timespec="seconds"), "argv": sys.argv[1:], "stages": stages}) + '\n')
+
+metrics = RunMetrics()
+
 def parse_args():
 	parser = argparse.ArgumentParser(description="Extract Perforce data to generate a visualization using Gource. Requires Gource (https://gource.io/).")
 	parser.add_argument("-u", "--p4-user", type=str, help="Perforce username")
@@ -39,20 +117,43 @@ def parse_args():
 	parser.add_argument("-o", "--output", type=str, default="p4-gource", help="Base name for output files")
 	parser.add_argument("-s", "--start-rev", type=int, default=1, help="Starting changelist number")
 	parser.add_argument("-e", "--end-rev", type=int, default=None, help="Ending changelist number")
+	parser.add_argument("--since", type=str, default=None, help="Start at the first changelist submitted at or after this date, 'YYYY/MM/DD[ HH:MM[:SS]]' in the server timezone, instead of --start-rev")
+	parser.add_argument("--until", type=str, default=None, help="End at the last changelist submitted at or before this date (the whole day without a time), instead of --end-rev")
 	parser.add_argument("-b", "--batch-size", type=int, default=1000, help="Number of changelists per batch when fetching logs")
+	parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of describe requests run concurrently against the server")
+	parser.add_argument("--convert-jobs", type=int, default=1, help="Number of processes converting P4 logs to Gource logs in parallel")
+	parser.add_argument("--describe-size", type=int, default=50, help="Number of changelists described by a single p4 process")
 	parser.add_argument("-m", "--regex-match", action="append", default=[], help="Match and reduce paths using regex, requires a replace regex (can specify multiple)")
 	parser.add_argument("-r", "--regex-replace", action="append", default=[], help="Reduce paths using regex, requires a match regex (can specify multiple)")
+	parser.add_argument("--server-timezone", type=str, default=None, help="Timezone of the P4 server timestamps, e.g. America/Los_Angeles (default: local timezone)")
+	parser.add_argument("--fallback-encoding", action="append", default=None, help="Encoding tried on the P4 log lines which are not valid UTF-8, e.g. the charset of a non unicode server (can specify multiple, default: cp1252)")
+	parser.add_argument("--profile", action="store_true", default=False, help="Profile the run with cProfile and write the statistics to <output>.prof")
 	parser.add_argument("-v", "--verbose", action="store_true", default=False, help="Verbose logging")
 	parser.add_argument("--fetch-only", action="store_true", default=False, help="Only fetch logs from P4, do not run Gource or video rendering")
 	parser.add_argument("--skip-fetch", action="store_true", default=False, help="Do not fetch, only run Gource and video rendering")
+	parser.add_argument("--retry-delay", type=float, default=1.0, help="Seconds before the first retry of a failed p4 command, doubled at each retry up to a minute, with jitter")
+	parser.add_argument("--skip-prescan", action="store_true", default=False, help="Describe every changelist number of the range instead of listing the submitted changelists first")
+	parser.add_argument("--stream", action="store_true", default=False, help="Write the Gource logs directly while fetching, without reparsing the P4 logs")
+	parser.add_argument("--skip-p4-log", action="store_true", default=False, help="With --stream, do not write the P4 logs")
+	parser.add_argument("--store", action="store_true", default=False, help="Fetch unfiltered changelists into a local SQLite store and generate Gource logs from it with the current filters")
 	parser.add_argument("--skip-init", action="store_true", default=False, help="Do not add the list of files present in the repository, only visualize changes in the revision range")
 	parser.add_argument("--skip-render", action="store_true", default=False, help="Open gource interactive, do not render video")
+	parser.add_argument("--pipe", action="store_true", default=False, help="Stream the Gource log to the stdin of Gource instead of writing the full log file")
+	parser.add_argument("--skip-merge", action="store_true", default=False, help="Concatenate the Gource logs as they are instead of merging them by timestamp and dropping duplicates")
+	parser.add_argument("--coalesce-window", type=int, default=0, help="Drop the modifications of a path within this many seconds of its previous event in the Gource log")
+	parser.add_argument("--max-fanout", type=int, default=0, help="Sample the changelists touching more files down to this many events in the Gource log")
+	parser.add_argument("--rollup-depth", type=int, default=0, help="Roll up the events of files deeper than this many directories to their directory in the Gource log")
+	parser.add_argument("--views", type=str, default=None, help="JSON file of named views, each with its own include_path, exclude_path, regex_match and regex_replace lists, to generate a Gource log and video per view from a single scan")
+	parser.add_argument("--event-cache", action="store_true", default=False, help="Also write the Gource log as a columnar event cache next to it, for the stats command")
+	parser.add_argument("--render-segments", type=int, default=1, help="Split the timeline in this many segments rendered in parallel, then joined in the final video")
+	parser.add_argument("--encode-profile", choices=sorted(ffmpeg_profiles), default="review", help="FFmpeg encoding profile of the rendered video")
+	parser.add_argument("--frame-transport", choices=["ppm", "raw"], default="ppm", help="Pipe the PPM stream of Gource straight into FFmpeg, or relay it as raw RGB frames with an explicit size")
+	parser.add_argument("--follow", action="store_true", default=False, help="Keep Gource open and append newly submitted changelists as they come, instead of rendering a video")
+	parser.add_argument("--poll-interval", type=float, default=60, help="Seconds between two polls for new changelists with --follow")
 	parser.add_argument("--interactive", action="store_true", default=False, help="Lets the user interact with Gource, do no close it automatically")
 	parser.add_argument("--gource-args", nargs=argparse.REMAINDER, help="Additional arguments to pass to Gource")
 
 	args = parser.parse_args()
-	if not args.end_rev:
-		args.end_rev = get_latest_changelist()
 
 	global p4_server
 	p4_server = args.p4_server
@@ -62,6 +163,41 @@ def parse_args():
 	global verbose
 	verbose = args.verbose
 
+	global server_timezone
+	server_timezone = args.server_timezone
+
+	global retry_delay
+	retry_delay = args.retry_delay
+
+	global fallback_encodings
+	if args.fallback_encoding:
+		fallback_encodings = args.fallback_encoding
+
+	if args.jobs < 1:
+		raise RuntimeError(f"Invalid number of jobs: {args.jobs}")
+	if args.store and args.stream:
+		raise RuntimeError("--store and --stream cannot be combined")
+	if args.skip_p4_log and not args.stream:
+		raise RuntimeError("--skip-p4-log requires --stream")
+	if args.poll_interval <= 0:
+		raise RuntimeError(f"Invalid poll interval: {args.poll_interval}")
+	if args.render_segments < 1:
+		raise RuntimeError(f"Invalid number of render segments: {args.render_segments}")
+	if args.render_segments > 1 and (args.pipe or args.interactive or args.skip_render):
+		raise RuntimeError("--render-segments requires a rendered video from a log file, it cannot be combined with --pipe, --interactive or --skip-render")
+	if args.convert_jobs < 1:
+		raise RuntimeError(f"Invalid number of convert jobs: {args.convert_jobs}")
+	if args.describe_size < 1:
+		raise RuntimeError(f"Invalid describe size: {args.describe_size}")
+	if args.retry_delay < 0:
+		raise RuntimeError(f"Invalid retry delay: {args.retry_delay}")
+	if args.event_cache and args.pipe:
+		raise RuntimeError("--event-cache is written from the Gource log file, it cannot be combined with --pipe")
+	if args.views and (args.pipe or args.follow):
+		raise RuntimeError("--views writes a Gource log per view, it cannot be combined with --pipe or --follow")
+	if args.coalesce_window < 0 or args.max_fanout < 0 or args.rollup_depth < 0:
+		raise RuntimeError("--coalesce-window, --max-fanout and --rollup-depth cannot be negative")
+
 	if args.regex_match and args.regex_replace and len(args.regex_match) == len(args.regex_replace):
 		pass
 	elif not args.regex_match and not args.regex_replace:
@@ -81,41 +217,243 @@ def p4_cmd(args):
 		cmd.extend(args)
 	return cmd
 
-def get_latest_changelist():
-	# Run the p4 changes command to get the latest changelist
-	output = subprocess.check_output(p4_cmd(["-ztag", "changes", "-m", "1"]), stderr=subprocess.STDOUT, text=True)
-
-	# Parse the output using regular expressions
-	changelist_match = re.search(r'change (\d+)', output)
-
-	if changelist_match:
-		changelist_number = int(changelist_match.group(1))
-		return changelist_number
-	else:
-		raise RuntimeError("Failed to parse latest changelist number")
-
-def calculate_ranges(start_rev, end_rev, batch_size, out_base):
-	# Extract existing revision ranges from log filenames
-	regex = re.compile(rf"{re.escape(out_base)}_(\d+)-(\d+).p4.log")
-	existing_ranges = []
+# Typed records produced by the P4 client functions below
+P4Changelist = collections.namedtuple("P4Changelist", ["change", "user", "client", "time", "status", "description", "files"])
+P4File = collections.namedtuple("P4File", ["path", "revision", "action", "type", "change"])
+
+def p4_decode(value):
+	""" Decode a marshalled P4 value to str as UTF-8 or with the fallback encodings, replacing undecodable bytes with '_'. """
+	if not isinstance(value, bytes):
+		return str(value)
+	# Note that the encoding cannot be predicted here.
+	# A P4 server which is not set to unicode will return whatever encoding the input was in without transforming it.
+	return decode_p4_line(value)
+
+def p4_run_marshal(args):
+	""" Run a p4 -G command and yield each marshalled record as it is decoded from the output stream. """
+	with tempfile.TemporaryFile() as stderr:
+		process = subprocess.Popen(p4_cmd(["-G"] + args), stdout=subprocess.PIPE, stderr=stderr)
+		metrics.add("p4_processes")
+		try:
+			while True:
+				try:
+					record = marshal.load(process.stdout)
+				except EOFError:
+					break
+				metrics.add("p4_records")
+				yield {p4_decode(key): p4_decode(value) for key, value in record.items()}
+		finally:
+			process.stdout.close()
+			if process.poll() is None:
+				process.kill()
+			returncode = process.wait()
+
+		if returncode != 0:
+			stderr.seek(0)
+			raise subprocess.CalledProcessError(returncode, process.args, stderr=stderr.read())
+
+def p4_raise_error(record):
+	raise RuntimeError(f"P4 error: {record.get('data', '').strip()}")
+
+def p4_describe(changelists):
+	""" Describe many changelists with a single p4 process, yielding a P4Changelist for each one that exists. """
+	for record in p4_run_marshal(["describe", "-s"] + [str(changelist) for changelist in changelists]):
+		if record.get("code") == "error":
+			message = record.get("data", "")
+			if "unknown" in message or "no such changelist" in message:
+				continue # Skip this changelist, Perforce has many CL numbers not taken by actual changelists
+			p4_raise_error(record)
+		if record.get("code") != "stat":
+			continue
 
-	# List all files and extract valid ranges
-	for filename in os.listdir("."):
-		match = regex.match(filename)
-		if match:
-			start, end = map(int, match.groups())
-			existing_ranges.append((start, end))
+		files = []
+		index = 0
+		while f"depotFile{index}" in record:
+			files.append(P4File(
+				record[f"depotFile{index}"],
+				int(record.get(f"rev{index}", 0)),
+				record.get(f"action{index}", ""),
+				record.get(f"type{index}", ""),
+				int(record["change"])))
+			index += 1
+
+		yield P4Changelist(int(record["change"]), record.get("user", ""), record.get("client", ""), int(record.get("time", 0)),
+			record.get("status", "submitted"), record.get("desc", ""), files)
+
+def p4_files(path_spec, extra_args=[]):
+	""" List the files matching a path spec, yielding a P4File for each. """
+	for record in p4_run_marshal(["files"] + extra_args + [path_spec]):
+		if record.get("code") == "error":
+			if "no such file(s)" in record.get("data", ""):
+				continue
+			p4_raise_error(record)
+		if record.get("code") != "stat":
+			continue
+		yield P4File(record["depotFile"], int(record.get("rev", 0)), record.get("action", ""), record.get("type", ""), int(record.get("change", 0)))
+
+def p4_changes(args):
+	""" List changelists, yielding a P4Changelist without files for each. """
+	for record in p4_run_marshal(["changes"] + args):
+		if record.get("code") == "error":
+			p4_raise_error(record)
+		if record.get("code") != "stat":
+			continue
+		yield P4Changelist(int(record["change"]), record.get("user", ""), record.get("client", ""), int(record.get("time", 0)),
+			record.get("status", ""), record.get("desc", ""), [])
 
-	# Sort ranges and merge overlapping or contiguous ranges
-	existing_ranges.sort()
+def get_latest_changelist():
+	for changelist in p4_changes(["-m", "1"]):
+		return changelist.change
+	raise RuntimeError("Failed to parse latest changelist number")
+
+def resolve_end_rev(out_base, skip_fetch, store=None):
+	""" Return the ending changelist when none was given: with --skip-fetch the last one fetched, so that rendering from the fetched data
+	needs no server, or else the latest one submitted on the server. """
+	if skip_fetch:
+		ranges = store_fetched_ranges(store) if store is not None else discover_p4_logs(out_base).keys()
+		end_rev = max((end for start, end in ranges), default=None)
+		if end_rev is not None:
+			print(f"Ending at the last fetched changelist: {end_rev}")
+			return end_rev
+	return get_latest_changelist()
+
+def p4_index_filename(out_base):
+	return f"{out_base}.p4.index"
+
+class ChangelistIndex:
+	""" Submit time of changelists, persisted as an append-only file of (change, time) records compacted to changelist order when loaded,
+	to resolve dates to changelist numbers by binary search. The index is complete up to covered_change, the last changelist listed from
+	the server, changelists indexed as they are fetched may leave gaps. A record with a negative change holds covered_change. """
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.pending = array.array('q')
+		self.loaded = False
+
+	def load(self):
+		""" Read the index, at the first query only, so that fetching can add to it without reading it. """
+		records = array.array('q')
+		if os.path.exists(self.filename):
+			with open(self.filename, 'rb') as index_file:
+				data = index_file.read()
+			records.frombytes(data[:len(data) - len(data) % 16])  # Drop a record cut by an interruption
+		records.extend(self.pending)
+		self.covered_change = 0
+		entries = {}
+		for change, timestamp in zip(records[0::2], records[1::2]):
+			if change < 0:
+				self.covered_change = max(self.covered_change, timestamp)
+			else:
+				entries[change] = timestamp
+		self.changes = array.array('q', sorted(entries))
+		self.times = array.array('q', (entries[change] for change in self.changes))
+		# Submitted changelists are renumbered in submit order, the running maximum only guards the search against clock skew
+		self.max_times = array.array('q', itertools.accumulate(self.times, max))
+		self.loaded = True
+
+		compacted = len(records) != 2 * (len(self.changes) + 1) or any(a >= b for a, b in zip(self.changes, self.changes[1:]))
+		if compacted or self.pending:
+			self.pending = array.array('q')
+			temp_filename = self.filename + ".temp"
+			with open(temp_filename, 'wb') as index_file:
+				index_file.write(array.array('q', itertools.chain.from_iterable(zip(self.changes, self.times))).tobytes())
+				index_file.write(array.array('q', [-1, self.covered_change]).tobytes())
+			os.replace(temp_filename, self.filename)
+
+	def add(self, change, timestamp):
+		self.pending.extend((change, timestamp))
+		self.loaded = False
+
+	def set_covered(self, change):
+		self.pending.extend((-1, change))
+		self.loaded = False
+
+	def save(self):
+		""" Append the changelists added since the last save. """
+		if self.pending:
+			with open(self.filename, 'ab') as index_file:
+				index_file.write(self.pending.tobytes())
+			self.pending = array.array('q')
+
+	def first_change_since(self, epoch):
+		""" Return the first indexed changelist submitted at or after the epoch, or None. """
+		if not self.loaded:
+			self.load()
+		position = bisect.bisect_left(self.max_times, epoch)
+		return self.changes[position] if position < len(self.changes) else None
+
+	def last_change_until(self, epoch):
+		""" Return the last indexed changelist submitted at or before the epoch, or None. """
+		if not self.loaded:
+			self.load()
+		position = bisect.bisect_right(self.max_times, epoch)
+		return self.changes[position - 1] if position > 0 else None
+
+def update_changelist_index(index):
+	""" Add the changelists submitted after the ones covered by the index, listed from the server for the whole depot,
+	as the index serves every run whatever its include paths. """
+	if not index.loaded:
+		index.load()
+	start = index.covered_change + 1
+	print(f"Updating the changelist index from changelist {start}")
+	changelists = {}
+	for changelist in p4_changes(["-s", "submitted", f"//...@{start},#head"]):
+		changelists[changelist.change] = changelist.time
+	for change in sorted(changelists):
+		index.add(change, changelists[change])
+	if changelists:
+		index.set_covered(max(changelists))
+	index.save()
+	print(f"Indexed {len(changelists)} new changelists")
+
+def parse_date(date, end_of_day=False):
+	""" Convert a 'YYYY/MM/DD[ HH:MM[:SS]]' date, or with dashes and a T as in ISO 8601, to epoch in the server timezone.
+	Missing parts are the start of the day or minute, or their end with end_of_day. """
+	match = re.fullmatch(r"(\d{4})[/-](\d{2})[/-](\d{2})(?:[ T](\d{2}):(\d{2})(?::(\d{2}))?)?", date.strip())
+	if not match:
+		raise RuntimeError(f"Invalid date, expected YYYY/MM/DD[ HH:MM[:SS]]: {date}")
+	year, month, day, hour, minute, second = match.groups()
+	if hour is None:
+		hour, minute = ("23", "59") if end_of_day else ("00", "00")
+	if second is None:
+		second = "59" if end_of_day else "00"
+	return parse_p4_timestamp(f"{year}/{month}/{day} {hour}:{minute}:{second}")
+
+def resolve_date_range(since, until, start_rev, end_rev, index):
+	""" Resolve the --since and --until dates to a changelist range with the index. Returns the range and the (since, until) time window. """
+	since_epoch = parse_date(since) if since else None
+	until_epoch = parse_date(until, end_of_day=True) if until else None
+	if since_epoch is not None:
+		start_rev = index.first_change_since(since_epoch)
+	if until_epoch is not None:
+		end_rev = index.last_change_until(until_epoch)
+	if start_rev is None or end_rev is None or start_rev > end_rev:
+		raise RuntimeError(f"No changelist indexed between {since or 'the start'} and {until or 'the end'}")
+	print(f"Resolved {since or 'the start'} to {until or 'the end'} to changelists {start_rev} to {end_rev}")
+	return start_rev, end_rev, (since_epoch, until_epoch)
+
+def merge_ranges(ranges):
+	""" Sort ranges and merge overlapping or contiguous ranges. """
 	merged_ranges = []
 
-	for start, end in existing_ranges:
+	for start, end in sorted(ranges):
 		if merged_ranges and merged_ranges[-1][1] >= start - 1:
 			merged_ranges[-1] = (merged_ranges[-1][0], max(merged_ranges[-1][1], end))
 		else:
 			merged_ranges.append((start, end))
 
+	return merged_ranges
+
+@metrics.stage("ranges")
+def calculate_ranges(start_rev, end_rev, batch_size, out_base):
+	# Extract existing revision ranges from log filenames
+	existing_ranges = list(discover_p4_logs(out_base).keys())
+	return calculate_missing_ranges(existing_ranges, start_rev, end_rev, batch_size)
+
+@metrics.stage("ranges")
+def calculate_missing_ranges(existing_ranges, start_rev, end_rev, batch_size):
+	merged_ranges = merge_ranges(existing_ranges)
+
 	# Calculate the needed ranges based on the batch size
 	needed_ranges = []
 	current_rev = start_rev
@@ -135,83 +473,376 @@ def calculate_ranges(start_rev, end_rev, batch_size, out_base):
 
 	return needed_ranges
 
-def fetch_p4_log(ranges, out_base, include_paths, exclude_paths):
-	fetched_files = []
-	for start, end in ranges:
-		temp_log_filename = f"{out_base}_{start}-{end}_temp.p4.log"
-		final_log_filename = f"{out_base}_{start}-{end}.p4.log"
-
-		print(f"Fetching changelists from {start} to {end}")
-		with open(temp_log_filename, 'w', encoding='utf-8') as log_file:
-			error_occurred = False  # Flag to track if any error occurred
-			for i in range(start, end + 1):
-				if (i - start) % 100 == 99: # Just to keep printing for heartbeat to the user
-					print(f"Fetching changelist {i}")
-
-				cmd = p4_cmd(["describe", "-s", str(i)])
-				
-				max_retries = 5
-				retry_count = 0
-				success = False
-				while not success and retry_count < max_retries:
-					try:
-						cl = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-						# Check each line of the fetched log
-						changelist_description = ""
-						changelist_contains_files = False
-						for lineb in cl.splitlines():
-						
-							# Note that the encoding cannot be predicted here. 
-							# A P4 server which is not set to unicode will return whatever encoding the input was in without transforming it.
-							# Decode the byte data, replacing undecodable bytes with �
-							line = lineb.decode('utf-8', errors='replace')
-								
-							# Replace the Unicode replacement character with the desired replacement character
-							line = line.replace('\ufffd', '_')
-
-
-							if not line:
-								continue 
-
-							if "no such changelist" in line:
-								break # Skip this changelist, Perforce has many CL numbers not taken by actual changelists
-
-							file_match = p4_file.match(line)
-							if file_match:
-								file_path = file_match.group("file")
-								if filter_file(file_path, include_paths, exclude_paths):
-									changelist_description += line + '\n'
-									changelist_contains_files = True
-							else:
-								changelist_description += line + '\n'
-
-						if changelist_contains_files:
-							log_file.write(changelist_description)
-
-					except UnicodeDecodeError as e:
-						print(f"Error decoding changelist {i}: {str(e)}")
-					except Exception as e:
-						print(f"Error fetching changelist {i}: {str(e)}")
-							
-						retry_count += 1
-						print(f"Retry changelist {i} {retry_count}")
-					else:
-						success = True
-				
-				if not success:
-					error_occurred = True
-					break
-
-		if not error_occurred:
-			# Rename the temp log file to the final log file if no errors occurred
-			os.rename(temp_log_filename, final_log_filename)
-			fetched_files.append(final_log_filename)
-		else:
-			# Leave the temp file for potential diagnosis and recovery, as an error file
-			os.rename(temp_log_filename, "ERROR_" + final_log_filename)
-			raise Exception(f"Error occurred during fetching, check logs for more details.")
-		
-	return fetched_files
+def format_p4_changelist(changelist, include_paths, exclude_paths):
+	""" Format a changelist in the log format read by p4_to_gource, keeping only the filtered files. Returns an empty string if no file is left. """
+	file_filter = path_filter(include_paths, exclude_paths)
+	files = [f"... {file.path}#{file.revision} {file.action}" for file in changelist.files if file_filter(file.path)]
+	if not files:
+		return ""
+
+	lines = [f"Change {changelist.change} by {changelist.user}@{changelist.client} on {format_p4_timestamp(changelist.time)}"]
+	lines.extend('\t' + line for line in changelist.description.splitlines() if line)
+	lines.append("Affected files ...")
+	lines.extend(files)
+	return '\n'.join(lines) + '\n'
+
+def changelist_to_gource(changelist, include_paths, exclude_paths, regex_match, regex_replace):
+	""" Generate the Gource log entries of a changelist, keeping only the filtered files. """
+	file_filter = path_filter(include_paths, exclude_paths)
+	reducer = path_reducer(regex_match, regex_replace)
+	author = changelist.user.lower()
+	for file in changelist.files:
+		if file_filter(file.path):
+			action_code = gource_action(file.action)
+			pretty_file = reducer(file.path)
+			yield f"{changelist.time}|{author}|{action_code}|{pretty_file}\n"
+
+def wait_before_retry(retry_count):
+	""" Sleep before a retry with exponential backoff, jittered so that concurrent jobs do not hit the server again in lockstep. """
+	delay = min(retry_max_delay, retry_delay * 2 ** (retry_count - 1))
+	time.sleep(delay / 2 + random.uniform(0, delay / 2))
+
+def fetch_p4_changelists(changelists, max_retries=5):
+	""" Describe a group of changelists and return their submitted P4Changelist records, or None if every retry failed.
+	The records received before a failure are kept, retries only describe the changelists after them. """
+	records = []
+	remaining = changelists
+	retry_count = 0
+	while retry_count < max_retries:
+		try:
+			for changelist in p4_describe(remaining):
+				records.append(changelist)
+			# Skip pending and shelved changelists as they have not been submitted
+			return [changelist for changelist in records if changelist.status == "submitted"]
+
+		except Exception as e:
+			print(f"Error fetching changelists {remaining[0]} to {remaining[-1]}: {str(e)}")
+			if records:
+				remaining = [changelist for changelist in remaining if changelist > records[-1].change]
+				if not remaining:
+					return [changelist for changelist in records if changelist.status == "submitted"]
+
+			retry_count += 1
+			metrics.add("retries")
+			wait_before_retry(retry_count)
+			print(f"Retry changelists {remaining[0]} to {remaining[-1]} {retry_count}")
+
+	return None
+
+def describe_p4_changelists(executor, changelists, jobs, describe_size):
+	""" Describe changelists through the executor and yield the P4Changelist records in changelist order. """
+	# Describe several changelists per p4 process to save on process spawns
+	groups = [changelists[i:i + describe_size] for i in range(0, len(changelists), describe_size)]
+	described = 0
+	for group, records in zip(groups, ordered_results(executor, fetch_p4_changelists, groups, jobs * 2)):
+		if (described + len(group)) // 100 > described // 100: # Just to keep printing for heartbeat to the user
+			print(f"Fetching changelist {group[-1]}")
+		described += len(group)
+
+		if records is None:
+			raise RuntimeError(f"Failed to fetch changelists {group[0]} to {group[-1]}")
+		metrics.add("changelists_described", len(group))
+		yield from records
+
+def fetch_p4_submitted_changelists(start, end, out_base, include_paths, max_retries=5):
+	""" List the submitted changelists of a range, restricted to the include paths, and persist the list next to the logs unless out_base is None,
+	for a failed batch to resume with. The list is removed once the batch is complete. """
+	changes_filename = p4_changes_filename(out_base, start, end)
+	if out_base is not None and os.path.exists(changes_filename):
+		with open(changes_filename, 'r', encoding='utf-8') as changes_file:
+			return [int(line) for line in changes_file if line.strip()]
+
+	search_paths = [format_perforce_search_path(path) for path in include_paths] or ["//..."]
+
+	retry_count = 0
+	while True:
+		try:
+			changelists = set()
+			for path in search_paths:
+				for changelist in p4_changes(["-s", "submitted", f"{path}@{start},@{end}"]):
+					changelists.add(changelist.change)
+			break
+		except Exception as e:
+			retry_count += 1
+			metrics.add("retries")
+			if retry_count >= max_retries:
+				raise
+			print(f"Error listing changelists {start} to {end}: {str(e)}")
+			wait_before_retry(retry_count)
+			print(f"Retry listing changelists {start} to {end} {retry_count}")
+
+	changelists = sorted(changelists)
+	if out_base is None:
+		return changelists
+
+	temp_changes_filename = f"{out_base}_{start}-{end}_temp.p4.changes"
+	with open(temp_changes_filename, 'w', encoding='utf-8') as changes_file:
+		changes_file.writelines(f"{changelist}\n" for changelist in changelists)
+	os.replace(temp_changes_filename, changes_filename)
+	return changelists
+
+def p4_changes_filename(out_base, start, end):
+	return f"{out_base}_{start}-{end}.p4.changes"
+
+def p4_checkpoint_filename(out_base, start, end):
+	return f"{out_base}_{start}-{end}.p4.checkpoint"
+
+def recover_p4_batch(outputs, checkpoint_filename):
+	""" Recover the temp files of a batch left by a failed or interrupted fetch, as temp files or ERROR_ files, truncated to the last
+	checkpointed changelist. Returns that changelist to resume after it, or 0 to fetch the batch from its start. """
+	for temp_filename, final_filename in outputs:
+		if os.path.exists("ERROR_" + final_filename):
+			os.replace("ERROR_" + final_filename, temp_filename)
+	if not os.path.exists(checkpoint_filename):
+		return 0
+
+	# Each line is a changelist followed by the size of every output once it was written, the last line may be incomplete
+	checkpoint = None
+	with open(checkpoint_filename, 'r', encoding='utf-8') as checkpoint_file:
+		for line in checkpoint_file:
+			fields = line.split()
+			if line.endswith('\n') and len(fields) == len(outputs) + 1:
+				checkpoint = [int(field) for field in fields]
+	if checkpoint is None:
+		return 0
+	changelist, sizes = checkpoint[0], checkpoint[1:]
+	for (temp_filename, final_filename), size in zip(outputs, sizes):
+		if not os.path.exists(temp_filename) or os.path.getsize(temp_filename) < size:
+			return 0
+	for (temp_filename, final_filename), size in zip(outputs, sizes):
+		with open(temp_filename, 'r+b') as temp_file:
+			temp_file.truncate(size)
+	return changelist
+
+def ordered_results(executor, function, items, window):
+	""" Submit items to the executor, keeping at most window in flight, and yield the results in submission order. """
+	pending = collections.deque()
+	try:
+		for item in items:
+			pending.append(executor.submit(function, item))
+			if len(pending) >= window:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
+	finally:
+		# Do not keep the server busy with requests nobody will read, e.g. after an error
+		for future in pending:
+			future.cancel()
+
+def fetch_p4_batches(ranges, sink, jobs, describe_size, prescan, index, destination=""):
+	""" Fetch the ranges by batch, resuming each batch after the changelist the sink reports as already written,
+	and pass every described changelist to the sink. The submit time of the fetched changelists is added to the index, if any. """
+	total_changelists = 0
+	total_avoided = 0
+	total_start_time = time.time()
+	with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+		for start, end in ranges:
+			resume_after = sink.resume_point(start, end)
+
+			print(f"Fetching changelists from {start} to {end}{destination}" + (f" with {jobs} jobs" if jobs > 1 else ""))
+			batch_start_time = time.time()
+			if prescan:
+				# Only describe changelists known to be submitted, Perforce has many CL numbers not taken by actual changelists
+				changelists = fetch_p4_submitted_changelists(start, end, sink.out_base, sink.include_paths)
+				avoided = (end - start + 1) - len(changelists)
+				total_avoided += avoided
+				metrics.add("describes_avoided", avoided)
+				print(f"Pre-scan found {len(changelists)} submitted changelists, avoided {avoided} describe calls")
+			else:
+				changelists = list(range(start, end + 1))
+			if resume_after:
+				resumed = sum(1 for changelist in changelists if changelist <= resume_after)
+				changelists = changelists[resumed:]
+				metrics.add("changelists_resumed", resumed)
+				print(f"Resuming after changelist {resume_after} from the previous fetch, {len(changelists)} changelists left")
+
+			try:
+				described = 0
+				with sink.open_batch(start, end, resume_after) as write:
+					for changelist in describe_p4_changelists(executor, changelists, jobs, describe_size):
+						write(changelist)
+						if index is not None:
+							index.add(changelist.change, changelist.time)
+						described += 1
+			except Exception as e:
+				sink.abort_batch(start, end)
+				print(f"Error fetching changelists {start} to {end}: {str(e)}")
+				raise Exception(f"Error occurred during fetching, check logs for more details. Run again to resume from the last fetched changelist.")
+
+			sink.finish_batch(start, end)
+			if index is not None:
+				index.save()
+
+			# Only the changelists described by this run, not the ones resumed from a previous one
+			batch_changelists = described
+			metrics.add("changelists", batch_changelists)
+			batch_elapsed = max(time.time() - batch_start_time, 1e-6)
+			total_changelists += batch_changelists
+			print(f"Fetched {batch_changelists} changelists in {batch_elapsed:.1f}s ({batch_changelists / batch_elapsed:.1f} changelists/s)")
+
+	if total_changelists:
+		total_elapsed = max(time.time() - total_start_time, 1e-6)
+		print(f"Fetched {total_changelists} changelists in total in {total_elapsed:.1f}s ({total_changelists / total_elapsed:.1f} changelists/s)")
+		if prescan:
+			print(f"Pre-scan avoided {total_avoided} describe calls in total")
+
+class P4LogSink:
+	""" Batch P4 log files, and in stream mode batch Gource logs, written through temp files with a checkpoint per changelist,
+	so that a failed or interrupted batch resumes after its last checkpointed changelist. """
+
+	def __init__(self, out_base, include_paths, exclude_paths, stream, keep_p4_log, regex_match, regex_replace):
+		self.out_base = out_base
+		self.include_paths = include_paths
+		self.exclude_paths = exclude_paths
+		self.stream = stream
+		self.keep_p4_log = keep_p4_log
+		self.regex_match = regex_match
+		self.regex_replace = regex_replace
+		self.fetched_files = []
+
+	def outputs(self, start, end):
+		""" Pairs of temp and final filenames written for a batch. """
+		outputs = []
+		if not self.stream or self.keep_p4_log:
+			outputs.append((f"{self.out_base}_{start}-{end}_temp.p4.log", f"{self.out_base}_{start}-{end}.p4.log"))
+		if self.stream:
+			# Without a P4 log next to it, the batch Gource log is the record of the fetched range
+			gource_extension = "gource" if self.keep_p4_log else "p4.gource"
+			outputs.append((f"{self.out_base}_{start}-{end}_temp.{gource_extension}", f"{self.out_base}_{start}-{end}.{gource_extension}"))
+		return outputs
+
+	def resume_point(self, start, end):
+		return recover_p4_batch(self.outputs(start, end), p4_checkpoint_filename(self.out_base, start, end))
+
+	@contextlib.contextmanager
+	def open_batch(self, start, end, resume_after):
+		with contextlib.ExitStack() as stack:
+			mode = 'a' if resume_after else 'w'
+			files = [stack.enter_context(open(temp_filename, mode, encoding='utf-8')) for temp_filename, final_filename in self.outputs(start, end)]
+			checkpoint_file = stack.enter_context(open(p4_checkpoint_filename(self.out_base, start, end), mode, encoding='utf-8'))
+			log_file = files[0] if not self.stream or self.keep_p4_log else None
+			gource_file = files[-1] if self.stream else None
+
+			def write(changelist):
+				if log_file:
+					log_file.write(format_p4_changelist(changelist, self.include_paths, self.exclude_paths))
+				if gource_file:
+					gource_file.writelines(changelist_to_gource(changelist, self.include_paths, self.exclude_paths, self.regex_match, self.regex_replace))
+				# Checkpoint once the changelist is on disk, so that a later run can resume right after it
+				for file in files:
+					file.flush()
+				checkpoint_file.write(f"{changelist.change} {' '.join(str(file.tell()) for file in files)}\n")
+				checkpoint_file.flush()
+
+			yield write
+
+	def abort_batch(self, start, end):
+		# Leave the temp files as error files for diagnosis, the next run resumes from them
+		for temp_filename, final_filename in self.outputs(start, end):
+			if os.path.exists(temp_filename):
+				os.rename(temp_filename, "ERROR_" + final_filename)
+
+	def finish_batch(self, start, end):
+		# Rename the temp files to the final files as no errors occurred
+		outputs = self.outputs(start, end)
+		for temp_filename, final_filename in outputs:
+			os.rename(temp_filename, final_filename)
+			metrics.add_file_size("bytes_written", final_filename)
+		os.remove(p4_checkpoint_filename(self.out_base, start, end))
+		# The pre-scan list only serves to resume the batch, a later fetch of the range may use other include paths
+		changes_filename = p4_changes_filename(self.out_base, start, end)
+		if os.path.exists(changes_filename):
+			os.remove(changes_filename)
+		if not self.stream or self.keep_p4_log:
+			self.fetched_files.append(outputs[0][1])
+
+@metrics.stage("fetch")
+def fetch_p4_log(ranges, out_base, include_paths, exclude_paths, jobs=1, describe_size=50, prescan=True, stream=False, keep_p4_log=True, regex_match=[], regex_replace=[], index=None):
+	""" Fetch the ranges by batch and return the P4 log files written. In stream mode the batch Gource logs are written directly from the fetched records.
+	The submit time of the fetched changelists is added to the index, if any. """
+	sink = P4LogSink(out_base, include_paths, exclude_paths, stream, keep_p4_log, regex_match, regex_replace)
+	fetch_p4_batches(ranges, sink, jobs, describe_size, prescan, index)
+	return sink.fetched_files
+
+def open_p4_store(out_base):
+	""" Open the local changelist store, which keeps every fetched changelist with its unfiltered file actions. """
+	store = sqlite3.connect(f"{out_base}.p4.db")
+	store.executescript("""
+		CREATE TABLE IF NOT EXISTS changelists (change INTEGER PRIMARY KEY, user TEXT, client TEXT, time INTEGER, description TEXT);
+		CREATE TABLE IF NOT EXISTS files (change INTEGER, position INTEGER, path TEXT, revision INTEGER, action TEXT, type TEXT, PRIMARY KEY (change, position)) WITHOUT ROWID;
+		CREATE TABLE IF NOT EXISTS fetched_ranges (start_change INTEGER, end_change INTEGER, PRIMARY KEY (start_change, end_change));
+	""")
+	return store
+
+def store_fetched_ranges(store):
+	""" Return the merged changelist ranges already fetched into the store. """
+	return merge_ranges(store.execute("SELECT start_change, end_change FROM fetched_ranges").fetchall())
+
+def store_changelist(store, changelist):
+	store.execute("INSERT OR REPLACE INTO changelists VALUES (?, ?, ?, ?, ?)",
+		(changelist.change, changelist.user, changelist.client, changelist.time, changelist.description))
+	store.execute("DELETE FROM files WHERE change = ?", (changelist.change,))
+	store.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+		((changelist.change, position, file.path, file.revision, file.action, file.type) for position, file in enumerate(changelist.files)))
+
+class P4StoreSink:
+	""" Batches fetched into the store, unfiltered. Changelists are committed as they are fetched, so an interrupted batch
+	resumes after the last stored changelist, and the batch range is recorded once it is complete. """
+
+	def __init__(self, store, describe_size):
+		self.store = store
+		self.describe_size = describe_size
+		# The store is unfiltered, so the pre-scan covers the whole depot and is not persisted separately
+		self.out_base = None
+		self.include_paths = []
+
+	def resume_point(self, start, end):
+		# Changelists are stored in order, the last one of the range is where an interrupted fetch stopped
+		return self.store.execute("SELECT MAX(change) FROM changelists WHERE change BETWEEN ? AND ?", (start, end)).fetchone()[0]
+
+	@contextlib.contextmanager
+	def open_batch(self, start, end, resume_after):
+		stored = 0
+
+		def write(changelist):
+			nonlocal stored
+			store_changelist(self.store, changelist)
+			stored += 1
+			if stored % self.describe_size == 0:
+				self.store.commit()
+
+		yield write
+
+	def abort_batch(self, start, end):
+		self.store.commit()
+
+	def finish_batch(self, start, end):
+		self.store.execute("INSERT OR REPLACE INTO fetched_ranges VALUES (?, ?)", (start, end))
+		self.store.commit()
+
+@metrics.stage("fetch")
+def fetch_p4_store(ranges, store, jobs=1, describe_size=50, prescan=True, index=None):
+	""" Fetch the ranges by batch into the store, unfiltered. """
+	fetch_p4_batches(ranges, P4StoreSink(store, describe_size), jobs, describe_size, prescan, index, " into the store")
+
+def store_file_events(store, start_rev, end_rev):
+	""" Return the (time, user, path, action) of the file events of a changelist range in the store, in Gource log order. """
+	return store.execute("""
+		SELECT changelists.time, changelists.user, files.path, files.action
+		FROM files JOIN changelists ON changelists.change = files.change
+		WHERE files.change BETWEEN ? AND ?
+		ORDER BY changelists.time, files.change, files.position""", (start_rev, end_rev))
+
+def store_to_gource(store, start_rev, end_rev, gource_log, include_paths, exclude_paths, regex_match, regex_replace):
+	""" Write the Gource log entries of a changelist range from the store, applying the current filters. """
+	rows = store_file_events(store, start_rev, end_rev)
+	file_filter = path_filter(include_paths, exclude_paths)
+	reducer = path_reducer(regex_match, regex_replace)
+	for timestamp, user, path, action in rows:
+		if file_filter(path):
+			action_code = gource_action(action)
+			pretty_file = reducer(path)
+			gource_log.write(f"{timestamp}|{user.lower()}|{action_code}|{pretty_file}\n")
 
 def format_perforce_search_path(path):
 	# Format the given path for Perforce, adding ... wildcard if necessary
@@ -234,36 +865,85 @@ def compile_path_patterns(paths):
 		regex_patterns.append(re.compile(pattern))
 	return regex_patterns
 
-def filter_file(file, include_paths, exclude_paths):
-	""" Filter files based on compiled include and exclude regex patterns. """
-	# Compile include and exclude patterns on first use or when paths are updated
-	if not hasattr(filter_file, 'include_regexes') or filter_file.prev_include_paths != include_paths:
-		filter_file.include_regexes = compile_path_patterns(include_paths)
-		filter_file.prev_include_paths = include_paths
-	if not hasattr(filter_file, 'exclude_regexes') or filter_file.prev_exclude_paths != exclude_paths:
-		filter_file.exclude_regexes = compile_path_patterns(exclude_paths)
-		filter_file.prev_exclude_paths = exclude_paths
-
-	# Check if file matches any include pattern
-	if filter_file.include_regexes:
-		if not any(regex.match(file) for regex in filter_file.include_regexes):
+class PathFilter:
+	""" Include and exclude patterns compiled once. Patterns that are plain prefixes (no wildcard, or a trailing '...')
+	are checked with a single str.startswith, the others are combined into a single alternation regex. """
+
+	def __init__(self, include_paths, exclude_paths):
+		self.include_prefixes, self.include_regex = self.compile(include_paths)
+		self.exclude_prefixes, self.exclude_regex = self.compile(exclude_paths)
+		self.has_include = bool(include_paths)
+		self.has_exclude = bool(exclude_paths)
+
+	@staticmethod
+	def compile(paths):
+		prefixes = []
+		patterns = []
+		for path in paths:
+			prefix = path[:-3] if path.endswith("...") else path
+			if "..." in prefix:
+				patterns.append(compile_path_patterns([path])[0].pattern[1:])
+			else:
+				prefixes.append(prefix)
+		regex = re.compile("^(?:" + "|".join(patterns) + ")") if patterns else None
+		return tuple(prefixes), regex
+
+	@staticmethod
+	def matches(path, prefixes, regex):
+		return (prefixes and path.startswith(prefixes)) or (regex is not None and regex.match(path) is not None)
+
+	def __call__(self, path):
+		# Check if file matches any include pattern
+		if self.has_include and not self.matches(path, self.include_prefixes, self.include_regex):
 			return False
-	# Check if file matches any exclude pattern
-	if filter_file.exclude_regexes:
-		if any(regex.match(file) for regex in filter_file.exclude_regexes):
+		# Check if file matches any exclude pattern
+		if self.has_exclude and self.matches(path, self.exclude_prefixes, self.exclude_regex):
 			return False
-	return True
+		return True
+
+class PathReducer:
+	""" Regex match and replace rules compiled once, with a memo of the reduced paths as the same paths come up again and again. """
+
+	def __init__(self, regex_matches, regex_replaces, cache_size=1 << 20):
+		self.rules = [(re.compile(regex_match), regex_replace) for regex_match, regex_replace in zip(regex_matches, regex_replaces)]
+		self.reduce = functools.lru_cache(maxsize=cache_size)(self.reduce_uncached)
+
+	def reduce_uncached(self, path):
+		reduced_path = path
+		for regex, regex_replace in self.rules:
+			new_reduced_path = regex.sub(regex_replace, reduced_path)
+			if new_reduced_path != reduced_path:
+				if verbose:
+					print(f"Reduced {reduced_path} to {new_reduced_path}")
+				reduced_path = new_reduced_path
+		return reduced_path
+
+	def __call__(self, path):
+		return self.reduce(path) if self.rules else path
+
+@functools.lru_cache(maxsize=16)
+def get_path_filter(include_paths, exclude_paths):
+	return PathFilter(include_paths, exclude_paths)
+
+@functools.lru_cache(maxsize=16)
+def get_path_reducer(regex_matches, regex_replaces):
+	return PathReducer(regex_matches, regex_replaces)
+
+def path_filter(include_paths, exclude_paths):
+	""" Return the compiled filter for these include and exclude paths, shared between calls. """
+	return get_path_filter(tuple(include_paths), tuple(exclude_paths))
+
+def path_reducer(regex_matches, regex_replaces):
+	""" Return the compiled reducer for these regex rules, shared between calls so that its memo is too. """
+	return get_path_reducer(tuple(regex_matches), tuple(regex_replaces))
+
+def filter_file(file, include_paths, exclude_paths):
+	""" Filter files based on compiled include and exclude patterns. Hot loops should call path_filter once instead. """
+	return path_filter(include_paths, exclude_paths)(file)
 
 def reduce_path(path, regex_matches, regex_replaces):
-	"""Reduce the path by applying regex matches and replacements."""
-	reduced_path = path
-	for regex_match, regex_replace in zip(regex_matches, regex_replaces):
-		new_reduced_path = re.sub(regex_match, regex_replace, reduced_path)
-		if new_reduced_path != reduced_path:
-			if verbose:
-				print(f"Reduced {reduced_path} to {new_reduced_path}")
-			reduced_path = new_reduced_path
-	return reduced_path
+	"""Reduce the path by applying regex matches and replacements. Hot loops should call path_reducer once instead."""
+	return path_reducer(regex_matches, regex_replaces)(path)
 
 # Compile regex patterns outside of the function to compile them only once
 p4_entry = re.compile(r"^Change (?P<changelist>\d+) by (?P<author>\S+)@\S+ on (?P<timestamp>\S+ \S+)\s*(?P<pending>\*pending\*)?\s*$")
@@ -279,126 +959,332 @@ p4_action_to_gource = {
 	"purge": "D"
 }
 
-def convert_file_to_utf8_with_underscore(file_path):
-    """
-    Reads a binary file, attempts to decode it as UTF-8 replacing any undecodable bytes with '_',
-    and writes the output back to the same file in UTF-8 encoding.
-
-    Args:
-    file_path (str): The path to the file to be converted.
-    """
-    try:
-        # Read the file in binary mode
-        with open(file_path, 'rb') as file:
-            raw_data = file.read()
-        
-        # Decode the data, replace undecodable bytes with '_'
-        decoded_data = raw_data.decode('utf-8', errors='replace')
-        modified_data = decoded_data.replace('\ufffd', '_')
-        
-        # Write the modified data back to the file in UTF-8
-        with open(file_path, 'w', encoding='utf-8') as file:
-            file.write(modified_data)
-
-        print(f"Converted {file_path} to utf-8 successfully.")
-    
-    except Exception as e:
-        print(f"Failed to convert {file_path} to utf-8: {e}")
+def gource_action(action):
+	""" Gource action code of a P4 action, the move/add and move/delete of a move are the add and delete of a file. """
+	return p4_action_to_gource.get(action[len("move/"):] if action.startswith("move/") else action, "M")
+
+@functools.lru_cache(maxsize=1 << 18)
+def p4_slot_epoch(slot, timezone):
+	""" Epoch of the start of a 'YYYY/MM/DD HH:MM' quarter hour, in the given timezone or the local one. """
+	if timezone:
+		from zoneinfo import ZoneInfo
+		return int(datetime.datetime.strptime(slot, "%Y/%m/%d %H:%M").replace(tzinfo=ZoneInfo(timezone)).timestamp())
+	return int(time.mktime(time.strptime(slot, "%Y/%m/%d %H:%M")))
+
+def parse_p4_timestamp(timestamp):
+	""" Convert a 'YYYY/MM/DD HH:MM:SS' P4 timestamp to epoch, identical to time.mktime(time.strptime(...)) without a server timezone.
+	UTC offsets change on quarter hour boundaries at worst (e.g. the 30 minutes DST of Lord Howe), so the start of each
+	quarter hour is cached and the remaining minutes and seconds are added to it. """
+	if len(timestamp) != 19:
+		return int(time.mktime(time.strptime(timestamp, "%Y/%m/%d %H:%M:%S")))
+	minutes = int(timestamp[14:16])
+	quarter = minutes - minutes % 15
+	return p4_slot_epoch(f"{timestamp[:14]}{quarter:02d}", server_timezone) + (minutes - quarter) * 60 + int(timestamp[17:19])
+
+def format_p4_timestamp(epoch):
+	""" Format an epoch as a P4 timestamp, the reverse of parse_p4_timestamp. """
+	if server_timezone:
+		from zoneinfo import ZoneInfo
+		return datetime.datetime.fromtimestamp(epoch, ZoneInfo(server_timezone)).strftime("%Y/%m/%d %H:%M:%S")
+	return time.strftime("%Y/%m/%d %H:%M:%S", time.localtime(epoch))
+
+def decode_p4_line(line):
+	""" Decode a line of a P4 log as UTF-8 or with the first fallback encoding that can, or replace its undecodable bytes with '_'. """
+	for encoding in ["utf-8"] + fallback_encodings:
+		try:
+			return line.decode(encoding)
+		except (UnicodeDecodeError, LookupError):
+			pass
+	return line.decode('utf-8', errors='replace').replace('\ufffd', '_')
+
+def decode_p4_lines(data):
+	""" Decode a block of complete lines, at once when it is valid UTF-8 as usual, line by line otherwise. Returns an iterator on the lines. """
+	try:
+		text = data.decode('utf-8')
+	except UnicodeDecodeError:
+		text = '\n'.join(decode_p4_line(line) for line in data.split(b'\n'))
+	return io.StringIO(text, newline='\n')
+
+def read_p4_log_lines(p4_log_path, chunk_size=1 << 20):
+	""" Yield the lines of a P4 log read by chunks of bytes, decoded as UTF-8 with the fallback encodings for the lines which are not.
+	P4 servers which are not set to unicode return the text in whatever encoding it was submitted, so it may change from one line to the next. """
+	with open(p4_log_path, 'rb') as p4_log:
+		remainder = b""
+		while True:
+			chunk = p4_log.read(chunk_size)
+			if not chunk:
+				break
+			chunk = remainder + chunk
+			end = chunk.rfind(b'\n') + 1
+			remainder = chunk[end:]
+			yield from decode_p4_lines(chunk[:end])
+		yield from decode_p4_lines(remainder)
+
+def p4_log_events(p4_log_path):
+	""" Yield the (timestamp, author, action code, path) of the file events of the submitted changelists of a P4 log. """
+	author, timestamp, files, pending = None, None, False, False
+	line_count = 0
+	for line in read_p4_log_lines(p4_log_path):
+		line_count += 1
+		if line_count % 100000 == 0:
+			print(f"Now parsing line {line_count}")
+
+		entry = p4_entry.match(line)
+		if entry:
+			# Skip pending entries as they have not been submitted, up to the next entry
+			pending = bool(entry.group("pending"))
+			files = False  # Reset file processing
+			if pending:
+				continue
+			author = entry.group("author").lower()
+			timestamp = parse_p4_timestamp(entry.group("timestamp"))
+			continue
+
+		if not files and not pending and p4_affected_files.match(line):
+			files = True
+			continue
+
+		if files:
+			file = p4_file.match(line)
+			if file:
+				yield timestamp, author, p4_action_to_gource.get(file.group("action"), "M"), file.group("file")
 
 def p4_to_gource(p4_log_path, gource_log_path, include_paths, exclude_paths, regex_match, regex_replace):
+	""" Convert Perforce log to a Gource-compatible log format. Returns whether it was converted, rather than already existing. """
 	if os.path.exists(gource_log_path):
 		print(f"Using existing file {gource_log_path}")
-		return
+		return False
 
-	""" Convert Perforce log to a Gource-compatible log format. """
 	print(f"Converting P4 to gource format: {p4_log_path} -> {gource_log_path}")
-	with open(p4_log_path, 'r', encoding='utf-8') as p4_log, open(gource_log_path, 'w', encoding='utf-8') as gource_log:
-		author, timestamp, files, ignore_entry = None, None, False, False
-		line_count = 0
-		for line in p4_log:
-			line_count += 1
-			if line_count % 100000 == 0:
-				print(f"Now parsing line {line_count}")
+	with open(gource_log_path, 'w', encoding='utf-8') as gource_log:
+		file_filter = path_filter(include_paths, exclude_paths)
+		reducer = path_reducer(regex_match, regex_replace)
+		for timestamp, author, action_code, path in p4_log_events(p4_log_path):
+			if file_filter(path):
+				gource_log.write(f"{timestamp}|{author}|{action_code}|{reducer(path)}\n")
+	return True
 
+def init_worker(worker_verbose, worker_server_timezone, worker_fallback_encodings):
+	""" Carry the globals over to worker processes, which do not run parse_args when they are spawned. """
+	global verbose
+	verbose = worker_verbose
+	global server_timezone
+	server_timezone = worker_server_timezone
+	global fallback_encodings
+	fallback_encodings = worker_fallback_encodings
+
+@metrics.stage("convert")
+def convert_p4_logs(p4_log_paths, include_paths, exclude_paths, regex_match, regex_replace, jobs=1):
+	""" Convert P4 logs to Gource logs next to them, across a process pool when jobs > 1. Returns the Gource log paths in the same order. """
+	gource_log_paths = [p4_log_path.replace('.p4.log', '.gource') for p4_log_path in p4_log_paths]
+	count = len(p4_log_paths)
+	if jobs <= 1 or count <= 1:
+		converted = [p4_to_gource(p4_log_path, gource_log_path, include_paths, exclude_paths, regex_match, regex_replace)
+			for p4_log_path, gource_log_path in zip(p4_log_paths, gource_log_paths)]
+	else:
+		# Batches are independent files, each one is converted exactly as in the serial path
+		print(f"Converting {count} P4 logs with {min(jobs, count)} processes")
+		with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, count), initializer=init_worker, initargs=(verbose, server_timezone, fallback_encodings)) as executor:
+			converted = list(executor.map(p4_to_gource, p4_log_paths, gource_log_paths,
+				[include_paths] * count, [exclude_paths] * count, [regex_match] * count, [regex_replace] * count))
+
+	# Measured on the files, as the conversions may run in other processes, and only for the logs converted by this run
+	metrics.add("logs", sum(converted))
+	for p4_log_path, gource_log_path, was_converted in zip(p4_log_paths, gource_log_paths, converted):
+		if was_converted:
+			metrics.add_file_size("bytes_read", p4_log_path)
+			metrics.add_file_size("bytes_written", gource_log_path)
+	return gource_log_paths
+
+# Actions after which a file is no longer present in the depot, the ones excluded by p4 files -e
+p4_removed_actions = {"delete", "move/delete", "purge", "archive"}
+
+def p4_snapshot_filename(out_base, revision):
+	return f"{out_base}_snapshot_{revision}.p4.files"
+
+def p4_snapshot_header(include_paths, exclude_paths):
+	return f"# {json.dumps({'include_paths': include_paths, 'exclude_paths': exclude_paths})}\n"
+
+def read_p4_snapshot(snapshot_filename):
+	""" Yield the (path, action) of the files of a snapshot, after its header line. """
+	with open(snapshot_filename, 'r', encoding='utf-8') as snapshot:
+		next(snapshot)
+		for line in snapshot:
+			action, path = line.rstrip('\n').split(' ', 1)
+			yield path, action
+
+def write_p4_snapshot(snapshot_filename, include_paths, exclude_paths, files):
+	""" Write the (path, action) of the files present at a revision for these include paths, without the files of the exclude paths.
+	Snapshots are only filtered by exclude paths when derived from P4 logs, which were fetched without the excluded files. """
+	temp_snapshot_filename = snapshot_filename + ".temp"
+	with open(temp_snapshot_filename, 'w', encoding='utf-8') as snapshot:
+		snapshot.write(p4_snapshot_header(include_paths, exclude_paths))
+		for path, action in files:
+			snapshot.write(f"{action} {path}\n")
+	os.replace(temp_snapshot_filename, snapshot_filename)
+
+def find_p4_snapshot(out_base, revision, include_paths, exclude_paths):
+	""" Return the revision, filename and exclude paths of the latest snapshot at or before the revision for these include paths,
+	either complete or without the files of these exclude paths, or None. """
+	pattern = re.compile(rf"{re.escape(out_base)}_snapshot_(\d+).p4.files$")
+	headers = {p4_snapshot_header(include_paths, []): [], p4_snapshot_header(include_paths, exclude_paths): exclude_paths}
+	candidates = []
+	for filename in list_working_directory():
+		match = pattern.match(filename)
+		if match and int(match.group(1)) <= revision:
+			candidates.append((int(match.group(1)), filename))
+	for snapshot_revision, filename in sorted(candidates, reverse=True):
+		with open(filename, 'r', encoding='utf-8') as snapshot:
+			header = snapshot.readline()
+			if header in headers:
+				return snapshot_revision, filename, headers[header]
+	return None
+
+def fetched_file_events(start_rev, end_rev, out_base, store=None):
+	""" Return the (path, action) of the fetched file events of changelists start_rev to end_rev in order, or None if they were not all fetched.
+	The store has every file, P4 logs only have the files that passed the filters at the time they were fetched. """
+	if store is not None:
+		if not any(start <= start_rev and end >= end_rev for start, end in store_fetched_ranges(store)):
+			return None
+		return store.execute("SELECT path, action FROM files WHERE change BETWEEN ? AND ? ORDER BY change, position", (start_rev, end_rev))
+
+	# Gource logs streamed without a P4 log have reduced paths, they cannot be used
+	p4_logs = {key: filename for key, filename in discover_p4_logs(out_base).items() if filename.endswith('.p4.log')}
+	if not any(start <= start_rev and end >= end_rev for start, end in merge_ranges(p4_logs.keys())):
+		return None
+	selected_logs = [filename for (start, end), filename in sorted(p4_logs.items()) if end >= start_rev and start <= end_rev]
+	return p4_log_file_events(selected_logs, start_rev, end_rev)
+
+def p4_log_file_events(p4_log_paths, start_rev, end_rev):
+	for p4_log_path in p4_log_paths:
+		in_range = False
+		for line in read_p4_log_lines(p4_log_path):
 			entry = p4_entry.match(line)
 			if entry:
-				if entry.group("pending"):
-					continue  # Skip pending entries as they have not been submitted
-				author = entry.group("author").lower()
-				changelist = entry.group("changelist")
-				timestamp = int(time.mktime(time.strptime(entry.group("timestamp"), "%Y/%m/%d %H:%M:%S")))
-				files = False  # Reset file processing
-				continue
-
-			if not files and p4_affected_files.match(line):
-				files = True
+				in_range = not entry.group("pending") and start_rev <= int(entry.group("changelist")) <= end_rev
 				continue
-
-			if files:
+			if in_range:
 				file = p4_file.match(line)
-				if file and filter_file(file.group("file"), include_paths, exclude_paths):
-					action_code = p4_action_to_gource.get(file.group("action"), "M")
-					pretty_file = reduce_path(file.group('file'), regex_match, regex_replace)
-					formatted_entry = f"{timestamp}|{author}|{action_code}|{pretty_file}\n"
-					gource_log.write(formatted_entry)
-
-def p4_to_gource_safe(p4_log_path, gource_log_path, include_paths, exclude_paths, regex_match, regex_replace):
-	try:
-		p4_to_gource(p4_log_path, gource_log_path, include_paths, exclude_paths, regex_match, regex_replace)
-	except UnicodeDecodeError:
-		if os.path.exists(gource_log_path):
-			os.remove(gource_log_path)
-		convert_file_to_utf8_with_underscore(p4_log_path)
-		p4_to_gource(p4_log_path, gource_log_path, include_paths, exclude_paths, regex_match, regex_replace)
+				if file:
+					yield file.group("file"), ("move/" if file.group(2) else "") + file.group("action")
+
+def derive_p4_snapshot(revision, out_base, include_paths, exclude_paths, store=None):
+	""" Compute the snapshot at the revision from an earlier snapshot and the fetched file events in between, without any server request.
+	Only the files changed in between are held in memory, the snapshot itself is streamed. Returns the snapshot filename, or None.
+	The exclude paths are the ones the P4 logs were fetched with: a snapshot derived from them leaves the excluded files out. """
+	found = find_p4_snapshot(out_base, revision, include_paths, exclude_paths)
+	if found is None:
+		return None
+	snapshot_revision, snapshot_filename, snapshot_exclude_paths = found
+	if snapshot_revision == revision:
+		return snapshot_filename
+
+	events = fetched_file_events(snapshot_revision + 1, revision, out_base, store)
+	if events is None:
+		return None
+
+	# The excluded files cannot be brought up to date from P4 logs, which do not have their events
+	derived_exclude_paths = snapshot_exclude_paths if store is not None else exclude_paths
+	file_filter = path_filter(include_paths, derived_exclude_paths)
+	changes = {}  # path -> last action
+	for path, action in events:
+		if file_filter(path):
+			changes[path] = action
+	changed_count = len(changes)
+
+	def files():
+		for path, action in read_p4_snapshot(snapshot_filename):
+			if not file_filter(path):
+				continue
+			action = changes.pop(path, action)
+			if action not in p4_removed_actions:
+				yield path, action
+		# Files added since the snapshot
+		for path in sorted(changes):
+			if changes[path] not in p4_removed_actions:
+				yield path, changes[path]
+
+	new_snapshot_filename = p4_snapshot_filename(out_base, revision)
+	write_p4_snapshot(new_snapshot_filename, include_paths, derived_exclude_paths, files())
+	print(f"Derived snapshot at {revision} from snapshot at {snapshot_revision} and {changed_count} changed files")
+	return new_snapshot_filename
+
+def fetch_p4_snapshot(revision, out_base, include_paths):
+	""" Request the files present at the revision from the server and save them as a snapshot. Returns the snapshot filename. """
+	# Format include filters for Perforce
+	search_paths = [format_perforce_search_path(path) for path in include_paths]
 
-def fetch_p4_init(first_revision, out_base, include_paths, exclude_paths, regex_match, regex_replace):
+	def files():
+		for path in search_paths:
+			for file in p4_files(f"{path}@{revision}", ["-e"]):
+				yield file.path, file.action
+
+	snapshot_filename = p4_snapshot_filename(out_base, revision)
+	write_p4_snapshot(snapshot_filename, include_paths, [], files())
+	return snapshot_filename
+
+def p4_snapshot(revision, out_base, include_paths, exclude_paths, store=None):
+	""" Return the filename of the snapshot at the revision, only asking the server for the whole list of files when no snapshot can be derived.
+	The snapshot may leave out the files of the exclude paths. """
+	snapshot_filename = derive_p4_snapshot(revision, out_base, include_paths, exclude_paths, store)
+	if snapshot_filename is None:
+		snapshot_filename = fetch_p4_snapshot(revision, out_base, include_paths)
+	return snapshot_filename
+
+@metrics.stage("init")
+def fetch_p4_init(first_revision, out_base, include_paths, exclude_paths, regex_match, regex_replace, store=None):
 	output_filename = f"{out_base}_init_{first_revision}.gource"
 	
 	if os.path.exists(output_filename):
 		print(f"Warning: Using existing file {output_filename}")
 		return output_filename
-	
-	# Format include filters for Perforce
-	search_paths = [format_perforce_search_path(path) for path in include_paths]
+
+	file_filter = path_filter(include_paths, exclude_paths)
+	reducer = path_reducer(regex_match, regex_replace)
 
 	# Generate the Gource log file with fake initial revisions
 	try:
+		snapshot_filename = p4_snapshot(first_revision, out_base, include_paths, exclude_paths, store)
 		with open(output_filename, 'w', encoding='utf-8') as f:
-			for path in search_paths:
-				cmd = p4_cmd(["files", "-e", f"{path}@{first_revision}"])
-			
-				output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, text=True)
-				if "no such file(s)" in output:
-					continue
-
-				for line in output.splitlines():
-					match = re.match(r"^(.+?)#(\d+) - (\w+) change (\d+)", line)
-					if match:
-						file, rev, action, changelist = match.groups()
-						if filter_file(file, include_paths, exclude_paths):
-							action_code = p4_action_to_gource.get(action, "M")
-							pretty_file = reduce_path(file, regex_match, regex_replace)
-							formatted_entry = f"0|init|{action_code}|{pretty_file}\n"
-							f.write(formatted_entry)
-	except subprocess.CalledProcessError as e:
-		print(f"Error running p4 files command for path {path}: {str(e)}")
+			for path, action in read_p4_snapshot(snapshot_filename):
+				if file_filter(path):
+					action_code = gource_action(action)
+					pretty_file = reducer(path)
+					formatted_entry = f"0|init|{action_code}|{pretty_file}\n"
+					f.write(formatted_entry)
+	except (subprocess.CalledProcessError, RuntimeError) as e:
+		print(f"Error running p4 files command at revision {first_revision}: {str(e)}")
 		# Remove the partially written file if it exists
 		if os.path.exists(output_filename):
 			os.remove(output_filename)
 		return None  # Or handle the error in another way
 	
+	metrics.add_file_size("bytes_written", output_filename)
 	print(f"Generated initial revisions file: {output_filename}")
 	return output_filename
 
+def list_working_directory():
+	""" Return the filenames of the working directory, listed again only once it changed. A listing taken within 2 seconds of a change
+	is not reused, files created in the same tick of the filesystem timestamps would not change it again. """
+	global directory_listing
+	stat = os.stat('.')
+	key = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+	if directory_listing is not None and directory_listing[0] == key:
+		return directory_listing[1]
+	filenames = os.listdir('.')
+	directory_listing = (key, filenames) if time.time_ns() - stat.st_mtime_ns > 2_000_000_000 else None
+	return filenames
+
 def discover_p4_logs(out_base):
-	""" Scan the directory for all Perforce log files and return their revision ranges. """
+	""" Scan the directory for all Perforce log files, or Gource logs streamed without one, and return their revision ranges. """
 	p4_logs = {}
-	log_pattern = re.compile(rf"{re.escape(out_base)}_(\d+)-(\d+).p4.log$")
-	for filename in os.listdir('.'):
+	log_pattern = re.compile(rf"{re.escape(out_base)}_(\d+)-(\d+).p4.(log|gource)$")
+	for filename in list_working_directory():
 		match = log_pattern.match(filename)
 		if match:
 			start, end = int(match.group(1)), int(match.group(2))
-			p4_logs[(start, end)] = filename
+			if match.group(3) == "log" or (start, end) not in p4_logs:
+				p4_logs[(start, end)] = filename
 	return p4_logs
 
 def select_logs_for_range(p4_logs, start_rev, end_rev):
@@ -420,21 +1306,255 @@ def select_logs_for_range(p4_logs, start_rev, end_rev):
 
 	return selected_files
 
-def concatenate_gource_logs(gource_files, target_gource_filename):
+@metrics.stage("concatenate")
+def concatenate_gource_logs(gource_files, target_gource_filename, merge=True, reduction=None, time_window=None, shard_ranges=None):
 	""" Concatenate Gource files into one final log. """
 	""" Note that this can make a mess if the target_gource_filename is in gource_files """
 	if target_gource_filename in gource_files:
 		print(f"Using existing full log file {target_gource_filename}")
 		return
 	
-	with open(target_gource_filename, 'w', encoding='utf-8') as outfile:
-		for filename in gource_files:
-			with open(filename, 'r') as infile:
-				outfile.write(infile.read())
+	with open(target_gource_filename, 'wb') as outfile:
+		write_gource_logs(gource_files, outfile, merge, reduction, time_window, shard_ranges)
+	for filename in gource_files:
+		metrics.add_file_size("bytes_read", filename)
+	metrics.add_file_size("bytes_written", target_gource_filename)
 	print(f"Gource full log file created at {target_gource_filename}")
 
-def generate_gource(start_rev, end_rev, out_base, include_paths, exclude_paths, skip_init, regex_match, regex_replace):
-	target_gource_filename = f"{out_base}_{start_rev}-{end_rev}.gource"
+def append_file(filename, outfile):
+	""" Append a file to an open binary file or pipe with constant memory, copying in the kernel when possible. """
+	with open(filename, 'rb') as infile:
+		offset = 0
+		if hasattr(os, "sendfile"):
+			outfile.flush()
+			try:
+				while True:
+					sent = os.sendfile(outfile.fileno(), infile.fileno(), offset, 1 << 30)
+					if sent == 0:
+						return
+					offset += sent
+			except BrokenPipeError:
+				raise
+			except OSError:
+				# sendfile does not support this pair of files, carry on with a regular copy
+				infile.seek(offset)
+		shutil.copyfileobj(infile, outfile, 1 << 20)
+
+def read_gource_events(filename, shard, window):
+	""" Yield the lines of a Gource file as (timestamp, shard, sequence, line), sorted by timestamp within a window of lines.
+	Lines are sorted by chunks overlapping by a window, which is close to linear on the mostly sorted logs. """
+	buffer = []
+	with open(filename, 'rb') as infile:
+		for sequence, line in enumerate(infile):
+			if not line.endswith(b'\n'):
+				line += b'\n'
+			buffer.append((int(line[:line.index(b'|')]), shard, sequence, line))
+			if len(buffer) >= 2 * window:
+				buffer.sort()
+				yield from buffer[:window]
+				del buffer[:window]
+	buffer.sort()
+	yield from buffer
+
+def in_time_window(timestamp, time_window):
+	""" Whether an event is in a (since, until) window of epochs, either of which may be None. Init events (timestamp 0) always are. """
+	since, until = time_window
+	return not timestamp or ((since is None or timestamp >= since) and (until is None or timestamp <= until))
+
+def trim_gource_log(filename, outfile, time_window):
+	""" Append the events of a Gource file within the time window to an open binary file or pipe. Returns the number of events trimmed. """
+	trimmed = 0
+	with open(filename, 'rb') as infile:
+		for line in infile:
+			if in_time_window(int(line[:line.index(b'|')]), time_window):
+				outfile.write(line)
+			else:
+				trimmed += 1
+	return trimmed
+
+def overlapping_shards(shard_ranges):
+	""" Return the pairs of shards, by index, whose (start, end) changelist ranges overlap. A shard without a range overlaps none. """
+	overlapping = set()
+	for shard, shard_range in enumerate(shard_ranges):
+		for other, other_range in enumerate(shard_ranges):
+			if shard != other and shard_range and other_range and shard_range[0] <= other_range[1] and other_range[0] <= shard_range[1]:
+				overlapping.add((shard, other))
+	return overlapping
+
+def merge_gource_logs(gource_files, outfile, window=1000, time_window=None, shard_ranges=None):
+	""" Merge Gource files by timestamp to an open binary file or pipe, keeping the shard and line order for equal timestamps.
+	Shards may overlap: an event already written by an overlapping shard at the same timestamp is a duplicate and is dropped.
+	With the changelist range of each shard (None for the init file), only shards whose ranges overlap are compared, without them any two shards may overlap.
+	Events outside of the time window, if any, are trimmed.
+	Memory is bounded by the reordering window of each shard and by the events sharing a timestamp. """
+	streams = [read_gource_events(filename, shard, window) for shard, filename in enumerate(gource_files) if filename]
+	overlapping = overlapping_shards(shard_ranges) if shard_ranges is not None else None
+	current_timestamp = None
+	seen = {}  # line -> {shard: occurrences in the shard}, for the current timestamp
+	events = duplicates = out_of_order = trimmed = 0
+	for timestamp, shard, sequence, line in heapq.merge(*streams):
+		if time_window and not in_time_window(timestamp, time_window):
+			trimmed += 1
+			continue
+		if timestamp != current_timestamp:
+			if current_timestamp is not None and timestamp < current_timestamp:
+				out_of_order += 1
+			current_timestamp = timestamp
+			seen.clear()
+		# The init file is the only one at timestamp 0 and cannot overlap, do not keep its whole content around
+		# An occurrence is a duplicate when an overlapping shard already had as many, lines repeated by consecutive changelists are kept
+		if timestamp:
+			occurrences = seen.get(line)
+			if occurrences is None:
+				seen[line] = {shard: 1}
+				outfile.write(line)
+				events += 1
+				continue
+			occurrences[shard] = occurrence = occurrences.get(shard, 0) + 1
+			if any(other != shard and count >= occurrence and (overlapping is None or (shard, other) in overlapping) for other, count in occurrences.items()):
+				duplicates += 1
+				continue
+		outfile.write(line)
+		events += 1
+
+	metrics.add("events", events)
+	metrics.add("duplicates", duplicates)
+	print(f"Merged {len(streams)} Gource logs: {events} events, {duplicates} duplicates dropped")
+	if time_window:
+		metrics.add("events_trimmed", trimmed)
+		print(f"Trimmed {trimmed} events outside of the time window")
+	if out_of_order:
+		print(f"Warning: {out_of_order} events were out of order by more than {window} lines within their log")
+
+# Density reduction of the final Gource log, None when it is written as it is
+EventReduction = collections.namedtuple("EventReduction", ["coalesce_window", "max_fanout", "rollup_depth"])
+
+def gource_log_suffix(reduction, time_window=None):
+	""" Suffix of the final Gource log filename, so that logs reduced or trimmed with other settings are not reused. """
+	suffix = ""
+	if time_window:
+		suffix += f"_time-{time_window[0] or ''}-{time_window[1] or ''}"
+	if reduction is not None:
+		suffix += f"_reduced-c{reduction.coalesce_window}-f{reduction.max_fanout}-d{reduction.rollup_depth}"
+	return suffix
+
+class GourceEventReducer(io.RawIOBase):
+	""" Binary stream reducing the density of the Gource log written to it before passing it on to an open binary file or pipe:
+	the events of files deeper than rollup_depth directories become a modification of their directory at that depth, once per changelist;
+	changelists with more than max_fanout events are sampled down to max_fanout events spread over the changelist;
+	modifications of a path within coalesce_window seconds of its previous event are dropped, additions and deletions are always kept.
+	The events of a changelist are the consecutive lines with the same timestamp and author, of which only the last event of each path is kept.
+	Init events (timestamp 0) are only rolled up. """
+
+	def __init__(self, outfile, reduction):
+		self.outfile = outfile
+		self.reduction = reduction
+		self.partial_line = b""
+		self.changelist_key = None
+		self.changelist = {}  # path -> fields of the event of the current changelist
+		self.last_events = {}  # path -> timestamp of its last written event
+		self.counts = collections.Counter()
+
+	def writable(self):
+		return True
+
+	def write(self, data):
+		lines = (self.partial_line + bytes(data)).split(b'\n')
+		self.partial_line = lines.pop()
+		for line in lines:
+			self.add_event(line)
+		return len(data)
+
+	def add_event(self, line):
+		fields = line.rstrip(b'\r').split(b'|', 4)
+		if len(fields) < 4:
+			return
+		self.counts["events"] += 1
+		key = (fields[0], fields[1])
+		if key != self.changelist_key:
+			self.write_changelist()
+			self.changelist_key = key
+
+		path = fields[3]
+		if self.reduction.rollup_depth:
+			components = path.split(b'/')
+			# The empty components of the leading // are not directories
+			root = 2 if path.startswith(b'//') else 1 if path.startswith(b'/') else 0
+			if len(components) > root + self.reduction.rollup_depth + 1:
+				path = fields[3] = b'/'.join(components[:root + self.reduction.rollup_depth + 1])
+				fields[2] = b'M'
+				if path in self.changelist:
+					self.counts["rolled_up"] += 1
+					return
+		if path in self.changelist:
+			self.counts["repeated"] += 1
+		self.changelist[path] = fields
+
+	def write_changelist(self):
+		events = list(self.changelist.values())
+		self.changelist.clear()
+		if not events:
+			return
+		timestamp = int(self.changelist_key[0])
+
+		max_fanout = self.reduction.max_fanout
+		if max_fanout and timestamp and len(events) > max_fanout:
+			self.counts["sampled_out"] += len(events) - max_fanout
+			step = len(events) / max_fanout
+			events = [events[int(i * step)] for i in range(max_fanout)]
+
+		window = self.reduction.coalesce_window
+		for fields in events:
+			if window and timestamp:
+				last_timestamp = self.last_events.get(fields[3])
+				if fields[2] == b'M' and last_timestamp is not None and timestamp - last_timestamp < window:
+					self.counts["coalesced"] += 1
+					continue
+				self.last_events[fields[3]] = timestamp
+			self.outfile.write(b'|'.join(fields) + b'\n')
+			self.counts["written"] += 1
+
+		# Forget the paths last seen before the window, they cannot be coalesced anymore
+		if window and len(self.last_events) > (1 << 20):
+			self.last_events = {path: last_timestamp for path, last_timestamp in self.last_events.items() if timestamp - last_timestamp < window}
+
+	def finish(self):
+		""" Write the last changelist and report the events removed by each reduction. """
+		if self.partial_line:
+			self.add_event(self.partial_line)
+			self.partial_line = b""
+		self.write_changelist()
+		removed = self.counts["events"] - self.counts["written"]
+		for counter in ("repeated", "rolled_up", "sampled_out", "coalesced"):
+			metrics.add(f"events_{counter}", self.counts[counter])
+		print(f"Reduced the Gource log from {self.counts['events']} to {self.counts['written']} events, {removed} removed: "
+			f"{self.counts['repeated']} repeated in a changelist, {self.counts['rolled_up']} rolled up, {self.counts['sampled_out']} sampled out, {self.counts['coalesced']} coalesced")
+
+def write_gource_logs(gource_files, outfile, merge=True, reduction=None, time_window=None, shard_ranges=None):
+	""" Write the Gource files to an open binary file or pipe, merged by timestamp or one after the other, trimmed to the time window and reduced if requested. """
+	if reduction is not None:
+		reducer = GourceEventReducer(outfile, reduction)
+		write_gource_logs(gource_files, reducer, merge, None, time_window, shard_ranges)
+		reducer.finish()
+		return
+	if merge:
+		merge_gource_logs(gource_files, outfile, time_window=time_window, shard_ranges=shard_ranges)
+		return
+	trimmed = 0
+	for filename in gource_files:
+		if filename and time_window:
+			trimmed += trim_gource_log(filename, outfile, time_window)
+		elif filename:
+			append_file(filename, outfile)
+	if time_window:
+		metrics.add("events_trimmed", trimmed)
+		print(f"Trimmed {trimmed} events outside of the time window")
+
+@metrics.stage("generate")
+def generate_gource(start_rev, end_rev, out_base, include_paths, exclude_paths, skip_init, regex_match, regex_replace, convert_jobs=1, pipe=False, merge=True, reduction=None, time_window=None):
+	""" Generate the full Gource log and return its filename. With pipe, nothing is written and a function writing the log to a binary stream is returned instead.
+	With a (since, until) time window, the events of the batch logs outside of it are trimmed. """
+	target_gource_filename = f"{out_base}_{start_rev}-{end_rev}{gource_log_suffix(reduction, time_window)}.gource"
 	
 	if os.path.exists(target_gource_filename):
 		print(f"Warning: Using existing file {target_gource_filename}")
@@ -443,100 +1563,865 @@ def generate_gource(start_rev, end_rev, out_base, include_paths, exclude_paths,
 	# Build with what we have, result may be larger than desired range on purpose
 	p4_logs = discover_p4_logs(out_base)
 	selected_logs = select_logs_for_range(p4_logs, start_rev, end_rev)
-	gource_files = []
-	for key, p4_log_path in selected_logs.items():
-		gource_log_path = p4_log_path.replace('.p4.log', '.gource')
-		p4_to_gource_safe(p4_log_path, gource_log_path, include_paths, exclude_paths, regex_match, regex_replace)
-		gource_files.append(gource_log_path)
+	# Logs streamed without a P4 log are already in Gource format
+	p4_log_paths = [p4_log_path for p4_log_path in selected_logs.values() if not p4_log_path.endswith('.p4.gource')]
+	converted = dict(zip(p4_log_paths, convert_p4_logs(p4_log_paths, include_paths, exclude_paths, regex_match, regex_replace, convert_jobs)))
+	gource_files = [converted.get(p4_log_path, p4_log_path) for p4_log_path in selected_logs.values()]
 
 	actual_range = list(selected_logs.keys())
+	shard_ranges = list(actual_range)
 
 	if not skip_init:
 		#fetch or create "init" gource file, which contains a view of all the files present in the repository at the first revision
 		first_revision = actual_range[0][0]
+		if time_window and time_window[0] is not None:
+			# The events before the window are trimmed, the files they touched must be in the init file instead
+			first_revision = max(start_rev, first_revision)
 		gource_files.insert(0, fetch_p4_init(first_revision, out_base, include_paths, exclude_paths, regex_match, regex_replace))
+		shard_ranges.insert(0, None)
 
-	target_gource_filename = f"{out_base}_{actual_range[0][0]}-{actual_range[-1][1]}.gource"
-	concatenate_gource_logs(gource_files, target_gource_filename)
+	print(f"Actual revision range covered: {actual_range[0][0]} to {actual_range[-1][1]}")
+	if pipe:
+		return functools.partial(write_gource_logs, gource_files, merge=merge, reduction=reduction, time_window=time_window, shard_ranges=shard_ranges)
 
+	target_gource_filename = f"{out_base}_{actual_range[0][0]}-{actual_range[-1][1]}{gource_log_suffix(reduction, time_window)}.gource"
+	concatenate_gource_logs(gource_files, target_gource_filename, merge, reduction, time_window, shard_ranges)
+	return target_gource_filename
 
-	print(f"Actual revision range covered: {actual_range[0][0]} to {actual_range[-1][1]}")
+def write_store_gource(store, start_rev, end_rev, init_filename, include_paths, exclude_paths, regex_match, regex_replace, reduction, outfile):
+	""" Write the init file then the Gource log entries of a changelist range from the store to an open binary file or pipe, reduced if requested. """
+	if reduction is not None:
+		reducer = GourceEventReducer(outfile, reduction)
+		write_store_gource(store, start_rev, end_rev, init_filename, include_paths, exclude_paths, regex_match, regex_replace, None, reducer)
+		reducer.finish()
+		return
+	if init_filename:
+		append_file(init_filename, outfile)
+	gource_log = io.TextIOWrapper(outfile, encoding='utf-8', newline='\n')
+	try:
+		store_to_gource(store, start_rev, end_rev, gource_log, include_paths, exclude_paths, regex_match, regex_replace)
+		gource_log.flush()
+	finally:
+		gource_log.detach()
+
+@metrics.stage("generate")
+def generate_gource_from_store(store, start_rev, end_rev, out_base, include_paths, exclude_paths, skip_init, regex_match, regex_replace, pipe=False, reduction=None):
+	""" Generate the full Gource log from the store. It is always regenerated, so that it reflects the current filters.
+	With pipe, nothing is written and a function writing the log to a binary stream is returned instead. """
+	# Use the fetched range covering the start, result may be smaller than desired range if not everything was fetched
+	covered_range = next(((start, end) for start, end in store_fetched_ranges(store) if end >= start_rev and start <= end_rev), None)
+	if covered_range is None:
+		raise RuntimeError(f"No changelists fetched in the store for range {start_rev} to {end_rev}")
+	actual_start, actual_end = max(start_rev, covered_range[0]), min(end_rev, covered_range[1])
+
+	init_filename = None
+	if not skip_init:
+		#fetch or create "init" gource file, which contains a view of all the files present in the repository at the first revision
+		init_filename = fetch_p4_init(actual_start, out_base, include_paths, exclude_paths, regex_match, regex_replace, store)
+
+	print(f"Actual revision range covered: {actual_start} to {actual_end}")
+	write_log = functools.partial(write_store_gource, store, actual_start, actual_end, init_filename, include_paths, exclude_paths, regex_match, regex_replace, reduction)
+	if pipe:
+		return write_log
+
+	target_gource_filename = f"{out_base}_{actual_start}-{actual_end}{gource_log_suffix(reduction)}.gource"
+	print(f"Generating {target_gource_filename} from the store")
+	with open(target_gource_filename, 'wb') as outfile:
+		write_log(outfile)
 	return target_gource_filename
 
+# A named set of filters and path reductions, producing its own Gource log and video
+View = collections.namedtuple("View", ["name", "include_paths", "exclude_paths", "regex_match", "regex_replace"])
+
+def load_views(views_filename):
+	""" Read the views of a JSON file mapping each view name to its include_path, exclude_path, regex_match and regex_replace lists, all optional. """
+	with open(views_filename, 'r', encoding='utf-8') as views_file:
+		config = json.load(views_file)
+	views = []
+	for name, view in config.items():
+		if not re.fullmatch(r"[\w.-]+", name):
+			raise RuntimeError(f"Invalid view name, it is used in filenames: {name}")
+		unknown_keys = set(view) - {"include_path", "exclude_path", "regex_match", "regex_replace"}
+		if unknown_keys:
+			raise RuntimeError(f"Unknown settings in view {name}: {', '.join(sorted(unknown_keys))}")
+		if len(view.get("regex_match", [])) != len(view.get("regex_replace", [])):
+			raise RuntimeError(f"All match patterns of view {name} must have a corresponding replace pattern")
+		views.append(View(name, view.get("include_path", []), view.get("exclude_path", []), view.get("regex_match", []), view.get("regex_replace", [])))
+	if not views:
+		raise RuntimeError(f"No view defined in {views_filename}")
+	return views
+
+def check_views_fetched(views, include_paths, exclude_paths):
+	""" Reject the views reaching outside the files the P4 logs are fetched with: paths outside the include paths, or overlapping
+	the exclude paths, are missing from the logs. The patterns are compared by matching each one as a path against the other filters,
+	an overlap only reached through wildcards in the middle of both patterns goes unnoticed. """
+	include_filter = path_filter(include_paths, [])
+	for view in views:
+		uncovered = [path for path in view.include_paths or ["//..."] if include_paths and not include_filter(path)]
+		if uncovered:
+			raise RuntimeError(f"View {view.name} includes paths outside the include paths, which are not fetched without --store: {', '.join(uncovered)}")
+		view_filter = path_filter(view.include_paths, view.exclude_paths)
+		overlapping = [path for path in exclude_paths
+			if view_filter(path) or any(path_filter([path], [])(view_path) for view_path in view.include_paths or ["//..."])]
+		if overlapping:
+			raise RuntimeError(f"View {view.name} overlaps the exclude paths, which are not fetched without --store: {', '.join(overlapping)}")
+
+class ViewRouter:
+	""" Find the views a path belongs to, with the path reduced for each of them. Routes are memoized per path,
+	so the filters and reductions of all the views run once per distinct path rather than once per event. """
+
+	def __init__(self, views, max_routes=1 << 20):
+		self.views = [(path_filter(view.include_paths, view.exclude_paths), path_reducer(view.regex_match, view.regex_replace)) for view in views]
+		self.max_routes = max_routes
+		self.routes = {}
+
+	def __call__(self, path):
+		""" Return the (view index, reduced path) of every view matching the path. """
+		routes = self.routes.get(path)
+		if routes is None:
+			routes = [(index, reducer(path)) for index, (file_filter, reducer) in enumerate(self.views) if file_filter(path)]
+			if len(self.routes) < self.max_routes:
+				self.routes[path] = routes
+		return routes
+
+def p4_log_to_view_gource(p4_log_path, gource_log_paths, views):
+	""" Convert a P4 log to the Gource log of every view in a single pass, routing each file event to the views it matches. """
+	print(f"Converting P4 to gource format for {len(views)} views: {p4_log_path}")
+	router = ViewRouter(views)
+	temp_log_paths = [gource_log_path + ".temp" for gource_log_path in gource_log_paths]
+	with contextlib.ExitStack() as stack:
+		gource_logs = [stack.enter_context(open(temp_log_path, 'w', encoding='utf-8')) for temp_log_path in temp_log_paths]
+		for timestamp, author, action_code, path in p4_log_events(p4_log_path):
+			for index, pretty_file in router(path):
+				gource_logs[index].write(f"{timestamp}|{author}|{action_code}|{pretty_file}\n")
+	for temp_log_path, gource_log_path in zip(temp_log_paths, gource_log_paths):
+		os.replace(temp_log_path, gource_log_path)
+
+@metrics.stage("init")
+def fetch_p4_view_inits(first_revision, out_base, views, include_paths, exclude_paths, store=None):
+	""" Write the init file of every view from a single snapshot of the include paths, which must cover the views, without the files
+	of the exclude paths the P4 logs were fetched with. Returns the init filenames by view name. """
+	init_filenames = {view.name: f"{out_base}_{view.name}_init_{first_revision}.gource" for view in views}
+	if all(os.path.exists(init_filename) for init_filename in init_filenames.values()):
+		print(f"Warning: Using existing init files of the views at {first_revision}")
+		return init_filenames
+
+	router = ViewRouter(views)
+	try:
+		snapshot_filename = p4_snapshot(first_revision, out_base, include_paths, exclude_paths, store)
+		with contextlib.ExitStack() as stack:
+			init_files = [stack.enter_context(open(init_filenames[view.name], 'w', encoding='utf-8')) for view in views]
+			for path, action in read_p4_snapshot(snapshot_filename):
+				action_code = gource_action(action)
+				for index, pretty_file in router(path):
+					init_files[index].write(f"0|init|{action_code}|{pretty_file}\n")
+	except (subprocess.CalledProcessError, RuntimeError) as e:
+		print(f"Error running p4 files command at revision {first_revision}: {str(e)}")
+		for init_filename in init_filenames.values():
+			if os.path.exists(init_filename):
+				os.remove(init_filename)
+		return {view.name: None for view in views}
+
+	for init_filename in init_filenames.values():
+		metrics.add_file_size("bytes_written", init_filename)
+	print(f"Generated the initial revisions files of {len(views)} views")
+	return init_filenames
+
+@metrics.stage("generate")
+def generate_view_gource(start_rev, end_rev, out_base, views, include_paths, exclude_paths, skip_init, convert_jobs=1, merge=True, reduction=None, time_window=None):
+	""" Generate the full Gource log of every view, scanning each P4 log once for all the views. Returns the filenames by view name. """
+	p4_logs = discover_p4_logs(out_base)
+	selected_logs = select_logs_for_range(p4_logs, start_rev, end_rev)
+	streamed_logs = [p4_log_path for p4_log_path in selected_logs.values() if p4_log_path.endswith('.p4.gource')]
+	if streamed_logs:
+		raise RuntimeError(f"Views need the P4 logs, these logs were streamed without them: {', '.join(streamed_logs)}")
+	actual_range = list(selected_logs.keys())
+
+	# Batch Gource logs of each view, next to the P4 logs
+	view_logs = {view.name: [] for view in views}
+	conversions = []
+	for (start, end), p4_log_path in selected_logs.items():
+		gource_log_paths = [f"{out_base}_{view.name}_{start}-{end}.gource" for view in views]
+		for view, gource_log_path in zip(views, gource_log_paths):
+			view_logs[view.name].append(gource_log_path)
+		if all(os.path.exists(gource_log_path) for gource_log_path in gource_log_paths):
+			print(f"Using existing view files of {p4_log_path}")
+		else:
+			conversions.append((p4_log_path, gource_log_paths))
+
+	with metrics.stage("convert"):
+		if convert_jobs <= 1 or len(conversions) <= 1:
+			for p4_log_path, gource_log_paths in conversions:
+				p4_log_to_view_gource(p4_log_path, gource_log_paths, views)
+		else:
+			with concurrent.futures.ProcessPoolExecutor(max_workers=min(convert_jobs, len(conversions)), initializer=init_worker, initargs=(verbose, server_timezone, fallback_encodings)) as executor:
+				list(executor.map(p4_log_to_view_gource, *zip(*conversions), [views] * len(conversions)))
+		metrics.add("logs", len(conversions))
+		for p4_log_path, gource_log_paths in conversions:
+			metrics.add_file_size("bytes_read", p4_log_path)
+
+	init_filenames = {}
+	if not skip_init:
+		first_revision = actual_range[0][0]
+		if time_window and time_window[0] is not None:
+			first_revision = max(start_rev, first_revision)
+		init_filenames = fetch_p4_view_inits(first_revision, out_base, views, include_paths, exclude_paths)
+
+	print(f"Actual revision range covered: {actual_range[0][0]} to {actual_range[-1][1]}")
+	target_gource_filenames = {}
+	for view in views:
+		target_gource_filename = f"{out_base}_{view.name}_{actual_range[0][0]}-{actual_range[-1][1]}{gource_log_suffix(reduction, time_window)}.gource"
+		if os.path.exists(target_gource_filename):
+			print(f"Warning: Using existing file {target_gource_filename}")
+		else:
+			concatenate_gource_logs([init_filenames.get(view.name)] + view_logs[view.name], target_gource_filename, merge, reduction, time_window, [None] + actual_range)
+		target_gource_filenames[view.name] = target_gource_filename
+	return target_gource_filenames
+
+@metrics.stage("generate")
+def generate_view_gource_from_store(store, start_rev, end_rev, out_base, views, include_paths, skip_init, reduction=None):
+	""" Generate the full Gource log of every view from the store with a single query, routing each file event to the views it matches.
+	Returns the filenames by view name. """
+	covered_range = next(((start, end) for start, end in store_fetched_ranges(store) if end >= start_rev and start <= end_rev), None)
+	if covered_range is None:
+		raise RuntimeError(f"No changelists fetched in the store for range {start_rev} to {end_rev}")
+	actual_start, actual_end = max(start_rev, covered_range[0]), min(end_rev, covered_range[1])
+
+	init_filenames = {}
+	if not skip_init:
+		# The store has every file, the snapshot needs no exclude paths
+		init_filenames = fetch_p4_view_inits(actual_start, out_base, views, include_paths, [], store)
+
+	print(f"Actual revision range covered: {actual_start} to {actual_end}")
+	target_gource_filenames = {view.name: f"{out_base}_{view.name}_{actual_start}-{actual_end}{gource_log_suffix(reduction)}.gource" for view in views}
+	router = ViewRouter(views)
+	with contextlib.ExitStack() as stack:
+		outfiles = [stack.enter_context(open(target_gource_filenames[view.name], 'wb')) for view in views]
+		if reduction is not None:
+			outfiles = [GourceEventReducer(outfile, reduction) for outfile in outfiles]
+		for view, outfile in zip(views, outfiles):
+			if init_filenames.get(view.name):
+				append_file(init_filenames[view.name], outfile)
+		for timestamp, user, path, action in store_file_events(store, actual_start, actual_end):
+			routes = router(path)
+			if routes:
+				prefix = f"{timestamp}|{user.lower()}|{gource_action(action)}|"
+				for index, pretty_file in routes:
+					outfiles[index].write(f"{prefix}{pretty_file}\n".encode('utf-8'))
+		if reduction is not None:
+			for outfile in outfiles:
+				outfile.finish()
+
+	for target_gource_filename in target_gource_filenames.values():
+		metrics.add_file_size("bytes_written", target_gource_filename)
+	print(f"Generated the Gource logs of {len(views)} views from the store")
+	return target_gource_filenames
+
+# Columns of the event cache, as raw arrays which can be memory mapped: file name, array typecode and NumPy dtype
+event_cache_columns = [("timestamps.bin", 'q', "<i8"), ("authors.bin", 'i', "<i4"), ("paths.bin", 'i', "<i4"), ("actions.bin", 'B', "u1")]
+
+def event_cache_dirname(gource_log_path):
+	return gource_log_path[:-len(".gource")] + ".events" if gource_log_path.endswith(".gource") else gource_log_path + ".events"
+
+@metrics.stage("cache")
+def write_event_cache(gource_log_path, chunk_size=1 << 20):
+	""" Write the events of a Gource log as columns next to it: timestamps, author and path ids interned in authors.txt and paths.txt,
+	and action codes (the ASCII code of A, M or D). Returns the cache directory, which is only rewritten when the log is newer. """
+	cache_dirname = event_cache_dirname(gource_log_path)
+	meta_filename = os.path.join(cache_dirname, "meta.json")
+	if os.path.exists(meta_filename) and os.path.getmtime(meta_filename) >= os.path.getmtime(gource_log_path):
+		print(f"Using existing event cache {cache_dirname}")
+		return cache_dirname
+
+	print(f"Writing event cache {cache_dirname}")
+	os.makedirs(cache_dirname, exist_ok=True)
+	authors, paths = {}, {}
+	count = 0
+	with contextlib.ExitStack() as stack:
+		column_files = [stack.enter_context(open(os.path.join(cache_dirname, name), 'wb')) for name, typecode, dtype in event_cache_columns]
+		columns = [array.array(typecode) for name, typecode, dtype in event_cache_columns]
+
+		def flush_columns():
+			for column, column_file in zip(columns, column_files):
+				if sys.byteorder != 'little':
+					column.byteswap()
+				column.tofile(column_file)
+				del column[:]
+
+		with open(gource_log_path, 'rb') as gource_log:
+			for line in gource_log:
+				fields = line.rstrip(b'\r\n').split(b'|', 4)
+				if len(fields) < 4:
+					continue
+				columns[0].append(int(fields[0]))
+				columns[1].append(authors.setdefault(fields[1], len(authors)))
+				columns[2].append(paths.setdefault(fields[3], len(paths)))
+				columns[3].append(fields[2][0] if fields[2] else 0)
+				count += 1
+				if len(columns[0]) >= chunk_size:
+					flush_columns()
+		flush_columns()
+
+	for name, values in (("authors.txt", authors), ("paths.txt", paths)):
+		with open(os.path.join(cache_dirname, name), 'wb') as names_file:
+			names_file.writelines(value + b'\n' for value in values)
+	with open(meta_filename, 'w', encoding='utf-8') as meta_file:
+		json.dump({"events": count, "columns": {name: dtype for name, typecode, dtype in event_cache_columns}, "gource_log": gource_log_path}, meta_file)
+	metrics.add("events", count)
+	print(f"Cached {count} events, {len(authors)} authors and {len(paths)} paths")
+	return cache_dirname
+
+def tool_cache_filename():
+	cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+	return os.path.join(cache_dir, "p4-gource", "tools.json")
+
+def read_tool_cache():
+	try:
+		with open(tool_cache_filename(), 'r', encoding='utf-8') as cache_file:
+			return json.load(cache_file)
+	except (OSError, ValueError):
+		return {}
+
+def write_tool_cache(cache):
+	""" Write the tool cache, a cache which cannot be written only costs the discovery of the tools again next time. """
+	cache_filename = tool_cache_filename()
+	try:
+		os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+		with open(cache_filename + ".temp", 'w', encoding='utf-8') as cache_file:
+			json.dump(cache, cache_file, indent=1)
+		os.replace(cache_filename + ".temp", cache_filename)
+	except OSError as e:
+		print(f"Warning: Could not write the tool cache {cache_filename}: {e}")
+
+def probe_gource(command):
+	""" Run Gource with -help and return the version it reports, or None if it failed. """
+	try:
+		# Use subprocess.Popen to interact with Gource's interactive prompt
+		process = subprocess.Popen([command, "-help"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors='replace')
+		# Send an "Enter" key press to proceed through the interactive prompt
+		stdout, stderr = process.communicate(input='\n')
+	except FileNotFoundError:
+		return None
+	# Check if the process terminated successfully
+	if process.returncode != 0:
+		print(f"{command} was found but failed to execute properly.")
+		return None
+	match = re.search(r"Gource v?(\d[\w.-]*)", stdout + stderr)
+	return match.group(1) if match else "unknown"
+
 def find_gource_executable():
-	""" Attempt to run Gource commands and return the first successful one. """
+	""" Attempt to run Gource commands and return the first successful one. The result is cached with the path, size and modification time
+	of the executable, Gource is only run again once it was moved, upgraded or replaced. """
 	commands = ["gource"]  # Default command for Unix-like systems
 	if platform.system() == "Windows":
 		# Add Windows-specific executables
 		commands.extend(["gource.cmd", "gource.exe"])
 
+	cache = read_tool_cache()
 	for command in commands:
-		try:
-			# Use subprocess.Popen to interact with Gource's interactive prompt
-			process = subprocess.Popen([command, "-help"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-			# Send an "Enter" key press to proceed through the interactive prompt
-			process.communicate(input='\n')
-			# Wait for the process to complete
-			process.wait()
-			# Check if the process terminated successfully
-			if process.returncode == 0:
-				print(f"{command} is available and functional.")
-				return command
-			else:
-				print(f"{command} was found but failed to execute properly.")
-		except FileNotFoundError:
+		path = shutil.which(command)
+		if path is None:
+			continue
+		stat = os.stat(path)
+		signature = [path, stat.st_size, stat.st_mtime_ns]
+		cached = cache.get(command)
+		if cached and cached["signature"] == signature:
+			print(f"{command} {cached['version']} is available (cached).")
+			return command
+
+		version = probe_gource(command)
+		if version is None:
 			continue
+		print(f"{command} {version} is available and functional.")
+		cache[command] = {"signature": signature, "version": version}
+		write_tool_cache(cache)
+		return command
 
 	raise EnvironmentError("No valid Gource executable found.")
 
-def run_gource(gource, gource_log_path, gource_args, interactive, output_video, out_base):
+def feed_gource(process, write_log):
+	""" Write the log to the stdin of Gource and close it, Gource may exit before reading it all. """
+	try:
+		write_log(process.stdin)
+	except BrokenPipeError:
+		pass
+	finally:
+		try:
+			process.stdin.close()
+		except BrokenPipeError:
+			pass
+
+# Named FFmpeg encoding profiles, from the largest and slowest to encode to the smallest and fastest
+ffmpeg_profiles = {
+	"archive": ["-vcodec", "libx264", "-preset", "slow", "-crf", "18", "-pix_fmt", "yuv420p"],
+	"review": ["-vcodec", "libx264", "-preset", "medium", "-crf", "23", "-pix_fmt", "yuv420p"],
+	"quick-preview": ["-vcodec", "libx264", "-preset", "ultrafast", "-crf", "30", "-pix_fmt", "yuv420p"],
+}
+
+frame_rate = 60
+
+def ffmpeg_command(output_filename, profile="review", transport="ppm", frame_size=None):
+	""" FFmpeg command encoding the frames read on stdin, either raw RGB frames of frame_size or a PPM image stream. """
+	if transport == "raw":
+		width, height = frame_size
+		input_args = ["-f", "rawvideo", "-pix_fmt", "rgb24", "-video_size", f"{width}x{height}", "-framerate", str(frame_rate), "-i", "-"]
+	else:
+		input_args = ["-r", str(frame_rate), "-f", "image2pipe", "-vcodec", "ppm", "-i", "-"]
+	# No B-frames so that segments can be concatenated
+	return ["ffmpeg", "-y"] + input_args + ffmpeg_profiles[profile] + ["-threads", "0", "-bf", "0", output_filename]
+
+def read_ppm_frame(stream):
+	""" Read a binary PPM frame from the stream and return its size and pixels, or None at the end of the stream. """
+	tokens = []
+	token = b""
+	# Header made of 4 tokens: magic, width, height and maximum value, followed by a single whitespace
+	while len(tokens) < 4:
+		byte = stream.read(1)
+		if not byte:
+			if tokens or token:
+				raise RuntimeError("Truncated PPM frame header")
+			return None
+		if byte == b"#" and not token:
+			stream.readline()
+		elif byte.isspace():
+			if token:
+				tokens.append(token)
+				token = b""
+		else:
+			token += byte
+
+	magic, width, height, maxval = tokens
+	if magic != b"P6" or maxval != b"255":
+		raise RuntimeError(f"Unsupported PPM frame: {b' '.join(tokens)}")
+	width, height = int(width), int(height)
+	pixels = stream.read(width * height * 3)
+	if len(pixels) != width * height * 3:
+		raise RuntimeError("Truncated PPM frame")
+	return (width, height), pixels
+
+def pipe_frames(gource_output, output_filename, profile, stats):
+	""" Let Gource write its PPM stream straight into FFmpeg, only the frame count is read back from the FFmpeg progress report. """
+	ffmpeg_cmd = ffmpeg_command(output_filename, profile, "ppm")
+	ffmpeg_cmd[2:2] = ["-progress", "pipe:1"]
+	print("Executing FFmpeg:", ' '.join(ffmpeg_cmd))
+	ffmpeg_process = subprocess.Popen(ffmpeg_cmd, stdin=gource_output, stdout=subprocess.PIPE, text=True)
+	metrics.add("ffmpeg_processes")
+	# FFmpeg holds the pipe now, Gource gets a broken pipe if FFmpeg stops reading
+	gource_output.close()
+	frames = 0
+	for line in ffmpeg_process.stdout:
+		if line.startswith("frame="):
+			frames = int(line[len("frame="):])
+	metrics.add("frames", frames)
+	stats["frames"] = frames
+	stats["returncode"] = ffmpeg_process.wait()
+
+def relay_frames(gource_output, output_filename, profile, transport, stats):
+	""" Read the PPM stream of Gource and feed it to FFmpeg, started on the first frame so that raw frames get an explicit size. """
+	ffmpeg_process = None
+	frames = 0
+	try:
+		while True:
+			frame = read_ppm_frame(gource_output)
+			if frame is None:
+				break
+			frame_size, pixels = frame
+			if ffmpeg_process is None:
+				ffmpeg_cmd = ffmpeg_command(output_filename, profile, transport, frame_size)
+				print("Executing FFmpeg:", ' '.join(ffmpeg_cmd))
+				ffmpeg_process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE)
+				metrics.add("ffmpeg_processes")
+				stats["frame_size"] = frame_size
+			elif frame_size != stats["frame_size"]:
+				raise RuntimeError(f"Frame size changed from {stats['frame_size']} to {frame_size}")
+			if transport != "raw":
+				ffmpeg_process.stdin.write(b"P6\n%d %d\n255\n" % frame_size)
+			ffmpeg_process.stdin.write(pixels)
+			frames += 1
+			metrics.add("frames")
+	except BrokenPipeError:
+		print("FFmpeg stopped reading frames")
+	finally:
+		# Gource gets a broken pipe if we stop reading early
+		gource_output.close()
+		stats["frames"] = frames
+		if ffmpeg_process is not None:
+			try:
+				ffmpeg_process.stdin.close()
+			except BrokenPipeError:
+				pass
+			stats["returncode"] = ffmpeg_process.wait()
+		else:
+			stats["returncode"] = 1
+
+def render_video(gource_cmd, output_filename, gource_log=None, profile="review", transport="ppm"):
+	""" Render a video by piping the frames of Gource into FFmpeg, or relaying them as raw frames, and return the render statistics.
+	gource_log is an optional function writing the log to the stdin of Gource. """
+	print("Executing Gource:", ' '.join(gource_cmd))
+	start_time = time.time()
+	gource_output = subprocess.Popen(gource_cmd, stdin=subprocess.PIPE if gource_log else None, stdout=subprocess.PIPE)
+	metrics.add("gource_processes")
+	stats = {}
+	if transport == "ppm":
+		encoder = threading.Thread(target=pipe_frames, args=(gource_output.stdout, output_filename, profile, stats))
+	else:
+		encoder = threading.Thread(target=relay_frames, args=(gource_output.stdout, output_filename, profile, transport, stats))
+	encoder.start()
+	if gource_log:
+		feed_gource(gource_output, gource_log)
+	encoder.join()
+	gource_output.wait()
+
+	stats["seconds"] = time.time() - start_time
+	stats["bytes"] = os.path.getsize(output_filename) if os.path.exists(output_filename) else 0
+	return stats
+
+def write_encode_report(out_base, profile, transport, frames, seconds, output_bytes):
+	""" Print and record the encoding throughput and output size of a render, to compare profiles over time. """
+	video_minutes = frames / frame_rate / 60
+	report = {
+		"date": datetime.datetime.now().isoformat(timespec="seconds"),
+		"profile": profile,
+		"transport": transport,
+		"frames": frames,
+		"seconds": round(seconds, 3),
+		"encode_fps": round(frames / seconds, 2) if seconds else None,
+		"bytes": output_bytes,
+		"bytes_per_minute": round(output_bytes / video_minutes) if video_minutes else None,
+	}
+	print(f"Encoded {frames} frames with profile {profile} at {report['encode_fps']} fps, {report['bytes_per_minute']} bytes per minute of video")
+	with open(f"{out_base}_encode_report.jsonl", 'a', encoding='utf-8') as report_file:
+		report_file.write(json.dumps(report) + '\n')
+
+def split_gource_log(gource_log_path, segments, out_base):
+	""" Split a Gource log sorted by timestamp into segments of equal time span, and return their filenames.
+	Every segment after the first starts with a snapshot of the files present at its start, one second before its first event,
+	so that each segment can be rendered on its own and the segments join up with the same tree. The boundaries within idle spans
+	are skipped, a segment without any event would only render the snapshot, so there may be fewer segments than asked for. """
+	first_timestamp, last_timestamp = None, None
+	with open(gource_log_path, 'rb') as gource_log:
+		for line in gource_log:
+			timestamp = int(line[:line.index(b'|')])
+			if timestamp:  # Skip the init entries
+				first_timestamp = timestamp if first_timestamp is None else first_timestamp
+				last_timestamp = timestamp
+	if first_timestamp is None or last_timestamp <= first_timestamp:
+		return [gource_log_path]
+
+	boundaries = [first_timestamp + (last_timestamp - first_timestamp) * k // segments for k in range(1, segments)]
+	segment_filenames = [f"{out_base}_segment0.gource"]
+	files = {}  # Files present so far, in order of appearance
+	boundary = 0  # Next boundary to cross
+	segment_log = open(segment_filenames[0], 'wb')
+	try:
+		with open(gource_log_path, 'rb') as gource_log:
+			for line in gource_log:
+				timestamp = int(line[:line.index(b'|')])
+				if boundary < len(boundaries) and timestamp >= boundaries[boundary]:
+					# All the boundaries crossed since the previous event start a single segment
+					while boundary < len(boundaries) and timestamp >= boundaries[boundary]:
+						boundary += 1
+					segment_log.close()
+					segment_filenames.append(f"{out_base}_segment{len(segment_filenames)}.gource")
+					segment_log = open(segment_filenames[-1], 'wb')
+					snapshot_timestamp = str(timestamp - 1).encode()
+					segment_log.writelines(b"%s|init|A|%s\n" % (snapshot_timestamp, path) for path in files)
+				segment_log.write(line)
+
+				action, path = line.rstrip(b'\r\n').split(b'|', 4)[2:4]
+				if action == b'D':
+					files.pop(path, None)
+				else:
+					files[path] = None
+	finally:
+		segment_log.close()
+	return segment_filenames
+
+def render_video_segments(gource, gource_log_path, gource_args, segments, out_base, profile="review", transport="ppm"):
+	""" Render time segments of the log with one Gource and FFmpeg pair each, in parallel, then concatenate the videos without reencoding. """
+	segment_logs = split_gource_log(gource_log_path, segments, out_base)
+	segment_videos = [segment_log.replace('.gource', '.mp4') for segment_log in segment_logs]
+	print(f"Rendering {len(segment_logs)} segments in parallel")
+
+	def render_segment(segment_log, segment_video):
+		return render_video([gource, segment_log] + (gource_args or []) + ["--stop-at-end", "--disable-input", "-o", "-"], segment_video, None, profile, transport)
+
+	start_time = time.time()
+	with concurrent.futures.ThreadPoolExecutor(max_workers=len(segment_logs)) as executor:
+		segment_stats = list(executor.map(render_segment, segment_logs, segment_videos))
+	returncodes = [stats["returncode"] for stats in segment_stats]
+	if any(returncodes):
+		raise RuntimeError(f"Rendering failed for segments {[k for k, returncode in enumerate(returncodes) if returncode]}")
+
+	# Lossless concatenation with the concat demuxer, all segments share the same encoding parameters
+	output_filename = f"{out_base}.mp4"
+	concat_list_filename = f"{out_base}_segments.txt"
+	with open(concat_list_filename, 'w', encoding='utf-8') as concat_list:
+		concat_list.writelines(f"file '{os.path.abspath(segment_video)}'\n" for segment_video in segment_videos)
+	concat_cmd = ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", concat_list_filename, "-c", "copy", output_filename]
+	print("Executing FFmpeg:", ' '.join(concat_cmd))
+	subprocess.run(concat_cmd, check=True)
+	metrics.add("ffmpeg_processes")
+	write_encode_report(out_base, profile, transport, sum(stats["frames"] for stats in segment_stats), time.time() - start_time, os.path.getsize(output_filename))
+
+	for filename in segment_logs + segment_videos + [concat_list_filename]:
+		if filename != gource_log_path:
+			os.remove(filename)
+
+def poll_p4_changelists(last_changelist, include_paths):
+	""" List the changelists submitted after last_changelist under the include paths, in order. """
+	search_paths = [format_perforce_search_path(path) for path in include_paths] or ["//..."]
+	changelists = set()
+	for path in search_paths:
+		for changelist in p4_changes(["-s", "submitted", f"{path}@{last_changelist + 1},#head"]):
+			changelists.add(changelist.change)
+	return sorted(changelists)
+
+def generated_end_rev(start_rev, end_rev, out_base, store=None):
+	""" Return the last changelist covered by the Gource log generated for the range, which uses the fetched logs as they are
+	and so can end past the end revision, or the fetched range of the store and so end before it. """
+	if store is not None:
+		covered_range = next(((start, end) for start, end in store_fetched_ranges(store) if end >= start_rev and start <= end_rev), None)
+		return min(end_rev, covered_range[1]) if covered_range else end_rev
+	selected_logs = select_logs_for_range(discover_p4_logs(out_base), start_rev, end_rev)
+	return max((end for start, end in selected_logs), default=end_rev)
+
+@metrics.stage("follow")
+def follow_gource(gource, gource_log, gource_args, last_changelist, include_paths, exclude_paths, regex_match, regex_replace, poll_interval, describe_size=50):
+	""" Run Gource on its stdin, starting with the optional log, then poll the server for newly submitted changelists and append them
+	until Gource is closed. Nothing is kept from one poll to the next besides the last changelist number. """
+	base_cmd = [gource, "--log-format", "custom", "-"]
+	if gource_args:
+		base_cmd.extend(gource_args)
+
+	print("Executing Gource:", ' '.join(base_cmd))
+	gource_process = subprocess.Popen(base_cmd, stdin=subprocess.PIPE)
+	metrics.add("gource_processes")
+	try:
+		if callable(gource_log):
+			gource_log(gource_process.stdin)
+		elif gource_log:
+			append_file(gource_log, gource_process.stdin)
+		gource_process.stdin.flush()
+
+		print(f"Following changelists submitted after {last_changelist}, polling every {poll_interval}s")
+		while gource_process.poll() is None:
+			poll_start_time = time.time()
+			try:
+				changelists = poll_p4_changelists(last_changelist, include_paths)
+				for i in range(0, len(changelists), describe_size):
+					for changelist in p4_describe(changelists[i:i + describe_size]):
+						if changelist.status == "submitted":
+							gource_process.stdin.writelines(line.encode('utf-8') for line in changelist_to_gource(changelist, include_paths, exclude_paths, regex_match, regex_replace))
+							gource_process.stdin.flush()
+						# Once the changelist is in Gource, so that a failed poll does not append it again
+						last_changelist = changelist.change
+				if changelists:
+					print(f"Appended changelists {changelists[0]} to {changelists[-1]}")
+					last_changelist = changelists[-1]
+			except (subprocess.CalledProcessError, RuntimeError) as e:
+				# Keep the display running through server hiccups, the next poll picks up from the same changelist
+				print(f"Error polling changelists after {last_changelist}: {str(e)}")
+
+			# Wake up regularly to notice Gource closing
+			while gource_process.poll() is None and time.time() - poll_start_time < poll_interval:
+				time.sleep(min(1, poll_interval))
+	except BrokenPipeError:
+		pass
+	finally:
+		try:
+			gource_process.stdin.close()
+		except BrokenPipeError:
+			pass
+		gource_process.wait()
+	print("Gource closed, stopped following")
+
+@metrics.stage("render")
+def run_gource(gource, gource_log, gource_args, interactive, output_video, out_base, segments=1, profile="review", transport="ppm"):
+	""" Run Gource on a log file, or on the stdin when gource_log is a function writing the log to a binary stream. """
 	print("Running Gource")
-	base_cmd = [gource, gource_log_path]
+	piped = callable(gource_log)
+	if piped:
+		base_cmd = [gource, "--log-format", "custom", "-"]
+	else:
+		base_cmd = [gource, gource_log]
 
 	if gource_args:
 		base_cmd.extend(gource_args)
 
-	if output_video:
+	if not output_video:
+		metrics.add("gource_processes")
+
+	if output_video and segments > 1 and not piped:
+		render_video_segments(gource, gource_log, gource_args, segments, out_base, profile, transport)
+
+	elif output_video:
 
 		if not interactive:
 			base_cmd.extend(["--stop-at-end", "--disable-input"])
 
-		output_filename = f"{out_base}.mp4"
-
 		base_cmd.extend(["-o", "-"])
 
-		# TODO: improve FFMPEG parameters as it produces video that are not compressed enough
-		ffmpeg_cmd = [
-			"ffmpeg", "-y", "-r", "60", "-f", "image2pipe", "-vcodec", "ppm", "-i", "-",
-			"-vcodec", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p", "-crf", "1",
-			"-threads", "0", "-bf", "0", output_filename
-		]
-
-		print("Executing Gource:", ' '.join(base_cmd))
-		print("Executing FFmpeg:", ' '.join(ffmpeg_cmd))
-
-		gource_output = subprocess.Popen(base_cmd, stdout=subprocess.PIPE)
-		ffmpeg_process = subprocess.run(ffmpeg_cmd, stdin=gource_output.stdout)
+		stats = render_video(base_cmd, f"{out_base}.mp4", gource_log if piped else None, profile, transport)
+		if stats["returncode"] != 0:
+			raise RuntimeError("FFmpeg failed to encode the video")
+		write_encode_report(out_base, profile, transport, stats["frames"], stats["seconds"], stats["bytes"])
 
 	else:
 		print("Executing Gource:", ' '.join(base_cmd))
-		subprocess.run(base_cmd, check=True)
-
-if __name__ == "__main__":
-	args = parse_args()
+		gource_process = subprocess.Popen(base_cmd, stdin=subprocess.PIPE if piped else None)
+		if piped:
+			feed_gource(gource_process, gource_log)
+		if gource_process.wait() != 0:
+			raise subprocess.CalledProcessError(gource_process.returncode, base_cmd)
+
+def parse_stats_args(argv):
+	parser = argparse.ArgumentParser(prog="p4-gource.py stats", description="Aggregate the events of a Gource log written with --event-cache.")
+	parser.add_argument("gource_log", help="Gource log, or its .events cache directory")
+	parser.add_argument("--by", choices=["author", "directory", "action", "day", "week", "month"], action="append", default=None,
+		help="Aggregate the events by this key (can specify multiple, default: author, directory and month)")
+	parser.add_argument("--depth", type=int, default=2, help="Number of path components of the directories aggregated by --by directory")
+	parser.add_argument("--top", type=int, default=20, help="Number of author and directory rows shown, the most active first")
+	parser.add_argument("--include-init", action="store_true", default=False, help="Also count the init events (timestamp 0) of the files present at the start")
+	return parser.parse_args(argv)
+
+def import_numpy():
+	""" NumPy is only needed by the stats command. """
+	try:
+		import numpy
+	except ImportError:
+		raise RuntimeError("The stats command requires NumPy (pip install numpy)")
+	return numpy
+
+def load_event_cache(cache_dirname):
+	""" Memory map the columns of an event cache and read its author and path names. """
+	numpy = import_numpy()
+	with open(os.path.join(cache_dirname, "meta.json"), 'r', encoding='utf-8') as meta_file:
+		meta = json.load(meta_file)
+	columns = {}
+	for name, dtype in meta["columns"].items():
+		# An empty file cannot be memory mapped
+		columns[name[:-len(".bin")]] = numpy.memmap(os.path.join(cache_dirname, name), dtype=dtype, mode='r') if meta["events"] else numpy.zeros(0, dtype=dtype)
+	names = {}
+	for name in ("authors", "paths"):
+		with open(os.path.join(cache_dirname, f"{name}.txt"), 'r', encoding='utf-8', errors='replace') as names_file:
+			names[name] = [line.rstrip('\n') for line in names_file]
+	return columns, names
+
+def event_directories(paths, depth):
+	""" Return the directory at the depth of every path, and the id of each path's directory in that list. """
+	directory_ids = {}
+	path_directories = []
+	for path in paths:
+		components = path.split('/')
+		root = 2 if path.startswith('//') else 1 if path.startswith('/') else 0
+		# The file name itself is not a directory
+		directory = '/'.join(components[:min(root + depth, len(components) - 1)]) or '/'
+		path_directories.append(directory_ids.setdefault(directory, len(directory_ids)))
+	return list(directory_ids), path_directories
+
+def event_chunks(column, start, chunk_size=1 << 24):
+	""" Slices of a memory mapped column from start, so that the temporary arrays of the aggregates stay bounded. """
+	for chunk_start in range(start, len(column), chunk_size):
+		yield column[chunk_start:chunk_start + chunk_size]
+
+def leading_init_events(timestamps):
+	""" Number of init events (timestamp 0), which are all at the start of the log. """
+	numpy = import_numpy()
+	for chunk_start, chunk in zip(itertools.count(0, 1 << 24), event_chunks(timestamps, 0)):
+		nonzero = numpy.flatnonzero(chunk)
+		if len(nonzero):
+			return chunk_start + int(nonzero[0])
+	return len(timestamps)
+
+def stats_main(args):
+	numpy = import_numpy()
+	cache_dirname = args.gource_log if os.path.isdir(args.gource_log) else event_cache_dirname(args.gource_log)
+	if not os.path.isdir(cache_dirname):
+		raise RuntimeError(f"No event cache at {cache_dirname}, generate the Gource log with --event-cache first")
+	columns, names = load_event_cache(cache_dirname)
+
+	# Slice off the init events rather than select the others, the columns are only ever read in place
+	first_event = 0 if args.include_init else leading_init_events(columns["timestamps"])
+	print(f"{len(columns['timestamps']) - first_event} events from {cache_dirname}")
+	if first_event == len(columns["timestamps"]):
+		return
 
-	gource = find_gource_executable()
+	def column_counts(name, minlength):
+		return sum(numpy.bincount(chunk, minlength=minlength) for chunk in event_chunks(columns[name], first_event))
+
+	def print_counts(title, labels, counts, top=None):
+		order = numpy.argsort(-counts, kind='stable')
+		order = order[counts[order] > 0][:top]
+		print(title)
+		for index in order:
+			print(f"{counts[index]:>12} {labels[index]}")
+
+	for key in args.by or ["author", "directory", "month"]:
+		if key == "author":
+			counts = column_counts("authors", len(names["authors"]))
+			print_counts(f"Top {args.top} authors by events:", names["authors"], counts, args.top)
+		elif key == "directory":
+			# Count the events per path, then add up the paths of each directory
+			directories, path_directories = event_directories(names["paths"], args.depth)
+			path_counts = column_counts("paths", len(names["paths"]))
+			counts = numpy.bincount(path_directories, weights=path_counts, minlength=len(directories)).astype(numpy.int64)
+			print_counts(f"Top {args.top} directories by events (churn), at depth {args.depth}:", directories, counts, args.top)
+		elif key == "action":
+			counts = column_counts("actions", 256)
+			print_counts("Events by action:", [chr(code) for code in range(256)], counts)
+		else:
+			# Buckets in UTC, weeks start on Monday
+			unit = {"day": "D", "week": "W", "month": "M"}[key]
+			bucket_counts = collections.Counter()
+			for chunk in event_chunks(columns["timestamps"], first_event):
+				seconds = chunk.astype("datetime64[s]")
+				if key == "week":
+					buckets = (seconds - numpy.timedelta64(4, 'D')).astype("datetime64[W]") + numpy.timedelta64(4, 'D')
+					buckets = buckets.astype("datetime64[D]")
+				else:
+					buckets = seconds.astype(f"datetime64[{unit}]")
+				values, counts = numpy.unique(buckets, return_counts=True)
+				bucket_counts.update(dict(zip(values, counts.tolist())))
+			print(f"Events by {key}:")
+			for value in sorted(bucket_counts):
+				print(f"{bucket_counts[value]:>12} {value}")
+
+def main(args):
+	# The server and the tools are only queried by the stages which need them
+	gource = find_gource_executable() if not args.fetch_only else None
+
+	store = open_p4_store(args.output) if args.store else None
+	views = load_views(args.views) if args.views else None
+	if views and not store:
+		# The store has every file whatever the filters, the P4 logs only the ones passing them
+		check_views_fetched(views, args.include_path, args.exclude_path)
+
+	if args.end_rev is None and not args.until:
+		args.end_rev = resolve_end_rev(args.output, args.skip_fetch, store)
+
+	index = ChangelistIndex(p4_index_filename(args.output))
+	time_window = None
+	if args.since or args.until:
+		if not args.skip_fetch:
+			update_changelist_index(index)
+		args.start_rev, args.end_rev, time_window = resolve_date_range(args.since, args.until, args.start_rev, args.end_rev, index)
 
 	if not args.skip_fetch:
 		if args.start_rev >= 1 and args.end_rev > args.start_rev:
 			print(f"Fetching revision range: {args.start_rev} to {args.end_rev}")
-			ranges = calculate_ranges(args.start_rev, args.end_rev, args.batch_size, args.output)
-			if ranges:
-				fetched_files = fetch_p4_log(ranges, args.output, args.include_path, args.exclude_path)
-				# Convert fetched logs to Gource logs
-				for p4_log_path in fetched_files:
-					gource_log_path = p4_log_path.replace('.p4.log', '.gource')
-					p4_to_gource_safe(p4_log_path, gource_log_path, args.include_path, args.exclude_path, args.regex_match, args.regex_replace)
+			if store:
+				ranges = calculate_missing_ranges(store_fetched_ranges(store), args.start_rev, args.end_rev, args.batch_size)
+			else:
+				ranges = calculate_ranges(args.start_rev, args.end_rev, args.batch_size, args.output)
+			if ranges and store:
+				fetch_p4_store(ranges, store, args.jobs, args.describe_size, not args.skip_prescan, index)
+			elif ranges:
+				fetched_files = fetch_p4_log(ranges, args.output, args.include_path, args.exclude_path, args.jobs, args.describe_size, not args.skip_prescan,
+					args.stream, not args.skip_p4_log, args.regex_match, args.regex_replace, index)
+				# Convert fetched logs to Gource logs, streamed batches are already converted and views are converted on their own
+				if not args.stream and not views:
+					convert_p4_logs(fetched_files, args.include_path, args.exclude_path, args.regex_match, args.regex_replace, args.convert_jobs)
 			else:
 				print(f"All revisions already fetched")
 		else: 
@@ -545,12 +2430,61 @@ if __name__ == "__main__":
 		print(f"Skipped fetching revisions")
 
 	if args.fetch_only:
-		sys.exit(0)
+		return
 
 	#generate_gource_log
-	gource_log_path = generate_gource(args.start_rev, args.end_rev, args.output, args.include_path, args.exclude_path, args.skip_init, args.regex_match, args.regex_replace)
+	reduction = None
+	if args.coalesce_window or args.max_fanout or args.rollup_depth:
+		reduction = EventReduction(args.coalesce_window, args.max_fanout, args.rollup_depth)
+
+	if views:
+		if store:
+			view_logs = generate_view_gource_from_store(store, args.start_rev, args.end_rev, args.output, views, args.include_path, args.skip_init, reduction)
+		else:
+			view_logs = generate_view_gource(args.start_rev, args.end_rev, args.output, views, args.include_path, args.exclude_path, args.skip_init, args.convert_jobs, not args.skip_merge, reduction, time_window)
+		if args.event_cache:
+			for view in views:
+				write_event_cache(view_logs[view.name])
+		for view in views:
+			print(f"Rendering view {view.name}")
+			run_gource(gource, view_logs[view.name], args.gource_args, args.interactive, not args.skip_render, f"{args.output}_{view.name}", args.render_segments, args.encode_profile, args.frame_transport)
+		print(f"Done")
+		return
+
+	if store:
+		gource_log = generate_gource_from_store(store, args.start_rev, args.end_rev, args.output, args.include_path, args.exclude_path, args.skip_init, args.regex_match, args.regex_replace, args.pipe, reduction)
+	else:
+		gource_log = generate_gource(args.start_rev, args.end_rev, args.output, args.include_path, args.exclude_path, args.skip_init, args.regex_match, args.regex_replace, args.convert_jobs, args.pipe, not args.skip_merge, reduction, time_window)
+
+	if args.event_cache:
+		write_event_cache(gource_log)
+
+	if args.follow:
+		follow_gource(gource, gource_log, args.gource_args, generated_end_rev(args.start_rev, args.end_rev, args.output, store), args.include_path, args.exclude_path, args.regex_match, args.regex_replace, args.poll_interval, args.describe_size)
+		return
 
 	# render
-	run_gource(gource, gource_log_path, args.gource_args, args.interactive, not args.skip_render, args.output)
+	run_gource(gource, gource_log, args.gource_args, args.interactive, not args.skip_render, args.output, args.render_segments, args.encode_profile, args.frame_transport)
+
+	print(f"Done")
+
+if __name__ == "__main__":
+	if sys.argv[1:2] == ["stats"]:
+		stats_main(parse_stats_args(sys.argv[2:]))
+		sys.exit(0)
+
+	args = parse_args()
 
-	print(f"Done")
\ No newline at end of file
+	profiler = None
+	if args.profile:
+		profiler = cProfile.Profile()
+		profiler.enable()
+
+	try:
+		main(args)
+	finally:
+		if profiler:
+			profiler.disable()
+			profiler.dump_stats(f"{args.output}.prof")
+			print(f"Profile written to {args.output}.prof")
+		metrics.write(f"{args.output}_metrics.jsonl")
\ No newline at end of file